@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+"""Compare integer and sub-pixel centroids over the bundled test images.
+
+For every image, reports the `find_stars_pattern` iteration in which the
+pattern was found, the first one uses `c_err = 0.003`.
+
+Run it from the startrackerpy directory:
+
+    python -m benchmarks.centroids
+"""
+import argparse
+import os
+import time
+import cv2
+from server import catalog
+from server.startracker.image import ImageUtils
+
+
+def solve(gray, blurred, extraction, subpixel):
+    """Returns the find_stars_pattern stats of an image, and the time spent
+    extracting its stars."""
+    threshold = ImageUtils.get_threshold(blurred, 170)
+    thresh_image = cv2.threshold(blurred, threshold, 255, cv2.THRESH_BINARY)[1]
+    start = time.perf_counter()
+    stars = ImageUtils.get_image_stars(thresh_image, gray, method=extraction,
+                                       subpixel=subpixel)
+    elapsed = time.perf_counter() - start
+    stats = {}
+    if len(stars) >= 4:
+        pattern = catalog.find_stars_pattern(stars[0:4], err=0.010, stats=stats)
+        stats['solved'] = len(pattern) > 0
+
+    return stats, elapsed
+
+
+def main(args):
+    results = {False: [], True: []}
+    for filename in sorted(os.listdir(args.images)):
+        image = cv2.imread(f"{args.images}/{filename}")
+        if image is None:
+            continue
+        gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+        blurred = cv2.GaussianBlur(gray, (3, 3), 0)
+        line = f"{filename[:30]:30}"
+        for subpixel in [False, True]:
+            stats, elapsed = solve(gray, blurred, args.extraction, subpixel)
+            results[subpixel].append(stats)
+            iteration = stats['iterations'] if stats.get('solved') else '-'
+            line += f" | {iteration:>2} ({elapsed * 1000:.1f}ms)"
+        print(line)
+
+    for subpixel, name in [(False, "Integer"), (True, "Sub-pixel")]:
+        solved = [stats for stats in results[subpixel] if stats.get('solved')]
+        first = [stats for stats in solved if stats['iterations'] == 1]
+        iterations = sum(stats['iterations'] for stats in solved)
+        mean = iterations / len(solved) if solved else 0
+        print(f"{name} centroids: {len(solved)}/{len(results[subpixel])} "
+              f"solved, {len(first)} at c_err=0.003, "
+              f"{mean:.2f} iterations on average")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-i', '--images', dest='images',
+                        default='./server/startracker/test_images',
+                        help='Directory with the images to solve')
+    parser.add_argument('-e', '--extraction', dest='extraction',
+                        default='contours', choices=['contours', 'components'],
+                        help='Stars extraction method')
+
+    main(parser.parse_args())
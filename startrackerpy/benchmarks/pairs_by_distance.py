@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+"""Microbenchmark for Catalog.get_pairs_by_distance.
+
+Compares the sorted index range search against the former full scan of the
+guide stars catalog, using the same amount of queries `find_stars_pattern`
+does for a frame: 3 triangles x 3 kernels x 2 pairs for every `c_err` step.
+
+Run it from the startrackerpy directory:
+
+    python -m benchmarks.pairs_by_distance
+"""
+import argparse
+import time
+import numpy as np
+from server.startracker.catalog import Catalog
+
+
+def linear_pairs_by_distance(catalog, a, b):
+    """Former implementation, a boolean mask over the whole catalog."""
+    pairs = []
+    condition = (catalog._guide_stars_catalog[:, 2] > a) & \
+        (catalog._guide_stars_catalog[:, 2] < b)
+    indices = np.where(condition)
+    for i in indices[0]:
+        pairs.append([int(catalog._guide_stars_catalog[i][0]),
+                      int(catalog._guide_stars_catalog[i][1]),
+                      float(catalog._guide_stars_catalog[i][2])])
+
+    return pairs
+
+
+def linear_range(catalog, a, b):
+    """Former range selection alone, without building the pairs list."""
+    condition = (catalog._guide_stars_catalog[:, 2] > a) & \
+        (catalog._guide_stars_catalog[:, 2] < b)
+
+    return np.where(condition)
+
+
+def frame_queries(catalog, rng, err=0.010):
+    """Returns the (a, b) ranges queried while solving a single frame."""
+    queries = []
+    steps = np.arange(0.003, err, 0.001)
+    distances = rng.choice(catalog._guide_distances, size=18)
+    for c_err in steps:
+        for distance in distances:
+            queries.append((distance - distance * c_err,
+                            distance + distance * c_err))
+
+    return queries
+
+
+def time_frames(func, frames):
+    """Returns the mean time in seconds to run all the queries of a frame."""
+    start = time.perf_counter()
+    for queries in frames:
+        for a, b in queries:
+            func(a, b)
+
+    return (time.perf_counter() - start) / len(frames)
+
+
+def main(args):
+    catalogs_path = args.catalogs
+    catalog = Catalog(f"{catalogs_path}/hip_2000.csv",
+                      f"{catalogs_path}/guide_stars_2000_5.csv",
+                      f"{catalogs_path}/guide_stars_2000_5_labels.csv")
+    rng = np.random.default_rng(args.seed)
+    frames = [frame_queries(catalog, rng) for _ in range(args.frames)]
+
+    # Both implementations must return the same pairs
+    for a, b in frames[0]:
+        assert catalog.get_pairs_by_distance(a, b) == \
+            linear_pairs_by_distance(catalog, a, b)
+
+    linear = time_frames(lambda a, b: linear_pairs_by_distance(catalog, a, b),
+                         frames)
+    indexed = time_frames(catalog.get_pairs_by_distance, frames)
+    linear_search = time_frames(lambda a, b: linear_range(catalog, a, b),
+                                frames)
+    indexed_search = time_frames(catalog._get_pairs_range, frames)
+
+    print(f"Guide pairs: {len(catalog._guide_distances)}")
+    print(f"Queries per frame: {len(frames[0])}")
+    print(f"Linear scan: {linear * 1000:.2f} ms/frame")
+    print(f"Sorted index: {indexed * 1000:.2f} ms/frame")
+    print(f"Speedup: {linear / indexed:.1f}x")
+    print("Range selection only (without building the pairs lists):")
+    print(f"Linear scan: {linear_search * 1000:.2f} ms/frame")
+    print(f"Sorted index: {indexed_search * 1000:.3f} ms/frame")
+    print(f"Speedup: {linear_search / indexed_search:.1f}x")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-c', '--catalogs', dest='catalogs',
+                        default='./server/startracker/catalogs/out',
+                        help='Directory with the catalogs CSVs')
+    parser.add_argument('-f', '--frames', dest='frames', type=int, default=20,
+                        help='Number of frames to simulate')
+    parser.add_argument('-s', '--seed', dest='seed', type=int, default=0,
+                        help='Seed for the random queries')
+
+    main(parser.parse_args())
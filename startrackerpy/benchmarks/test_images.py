@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+"""Benchmark every stage of the solver over the bundled test images.
+
+For each image, times the threshold, get_image_stars, get_pairs_by_distance
+(the 6 pairs of the 4 brightest stars), _get_triplets (the triangle of the
+3 brightest stars), find_stars_pattern and draw_guide_stars stages, keeping
+the best of several repeats, and records whether the image was solved and
+the final `c_err`. The results are written to a JSON file, which can be
+compared against a previous run to find performance regressions.
+
+Run it from the startrackerpy directory:
+
+    python -m benchmarks.test_images -o results.json
+    python -m benchmarks.test_images -o new.json --compare results.json
+"""
+import argparse
+import itertools
+import json
+import os
+import platform
+import sys
+import time
+from datetime import datetime
+import cv2
+import numpy as np
+from server import catalog
+from server.startracker.image import ImageUtils
+
+STAGES = ['threshold', 'get_image_stars', 'get_pairs_by_distance',
+          '_get_triplets', 'find_stars_pattern', 'draw_guide_stars']
+
+
+def best_time(func, repeat, setup=None):
+    """Returns the result of the function and the best time of the repeats.
+
+    :param func: Function to time, it receives the result of setup.
+    :param repeat: Number of repeats.
+    :param setup: Function called before every repeat, not timed."""
+    best = float('inf')
+    result = None
+    for _ in range(repeat):
+        args = setup() if setup is not None else None
+        start = time.perf_counter()
+        result = func(args)
+        best = min(best, time.perf_counter() - start)
+
+    return result, best
+
+
+def benchmark_image(filename, repeat, err):
+    """Returns the results of an image: time in milliseconds of every stage,
+    number of stars, whether it was solved, the find_stars_pattern
+    iterations and its final c_err."""
+    image = cv2.imread(filename)
+    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    blurred = cv2.GaussianBlur(gray, (3, 3), 0)
+    timings = {}
+
+    def threshold(_):
+        value = ImageUtils.get_threshold(blurred, 170)
+        return cv2.threshold(blurred, value, 255, cv2.THRESH_BINARY)[1]
+    thresh_image, timings['threshold'] = best_time(threshold, repeat)
+
+    def get_stars(_):
+        return ImageUtils.get_image_stars(thresh_image, gray)
+    stars, timings['get_image_stars'] = best_time(get_stars, repeat)
+
+    result = {'stars': len(stars), 'solved': False, 'iterations': None,
+              'c_err': None}
+    if len(stars) < 4:
+        result['timings'] = timings
+        return result
+
+    # find_stars_pattern identifies the stars, so it gets new ones each time
+    stats = {}
+    pattern, timings['find_stars_pattern'] = best_time(
+        lambda stars: catalog.find_stars_pattern(stars[0:4], err=err, stats=stats),
+        repeat, setup=lambda: get_stars(None))
+    result['solved'] = len(pattern) > 0
+    result['iterations'] = stats.get('iterations')
+    result['c_err'] = stats.get('c_err')
+
+    # Queries of the last find_stars_pattern iteration
+    c_err = stats.get('c_err', 0.003)
+    distances = [a.get_distance(b) for a, b in itertools.combinations(stars[0:4], 2)]
+
+    def get_pairs(_):
+        for distance in distances:
+            catalog.get_pairs_by_distance(distance - distance * c_err,
+                                          distance + distance * c_err)
+    _, timings['get_pairs_by_distance'] = best_time(get_pairs, repeat)
+
+    _, timings['_get_triplets'] = best_time(
+        lambda stars: catalog._get_triplets(stars[0:3], err=c_err),
+        repeat, setup=lambda: get_stars(None))
+
+    if result['solved']:
+        _, timings['draw_guide_stars'] = best_time(
+            lambda args: ImageUtils.draw_guide_stars(*args, max=10),
+            repeat, setup=lambda: (image.copy(), get_stars(None), pattern[0]))
+
+    result['timings'] = timings
+    return result
+
+
+def compare(results, baseline, tolerance):
+    """Print the stages slower than in the baseline.
+
+    :return: Number of regressions found."""
+    regressions = 0
+    for image, result in results['images'].items():
+        previous = baseline['images'].get(image)
+        if previous is None:
+            continue
+        if previous['solved'] and not result['solved']:
+            print(f"{image}: not solved anymore")
+            regressions += 1
+        for stage, elapsed in result['timings'].items():
+            before = previous['timings'].get(stage)
+            if before and elapsed > before * (1 + tolerance):
+                print(f"{image}: {stage} {before:.2f}ms -> {elapsed:.2f}ms")
+                regressions += 1
+
+    return regressions
+
+
+def main(args):
+    results = {
+        'date': datetime.now().isoformat(),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'opencv': cv2.__version__,
+        'repeat': args.repeat,
+        'images': {},
+    }
+    for filename in sorted(os.listdir(args.images)):
+        path = f"{args.images}/{filename}"
+        if not os.path.isfile(path) or cv2.imread(path) is None:
+            continue
+        result = benchmark_image(path, args.repeat, args.err)
+        result['timings'] = {stage: elapsed * 1000
+                             for stage, elapsed in result['timings'].items()}
+        results['images'][filename] = result
+        timings = " ".join(f"{stage}={result['timings'][stage]:.2f}ms"
+                           for stage in STAGES if stage in result['timings'])
+        print(f"{filename}: solved={result['solved']} c_err={result['c_err']} "
+              f"{timings}")
+
+    with open(args.output, 'w') as output:
+        json.dump(results, output, indent=2)
+    print(f"Results written to {args.output}")
+
+    if args.compare is not None:
+        with open(args.compare, 'r') as baseline_file:
+            baseline = json.load(baseline_file)
+        regressions = compare(results, baseline, args.tolerance)
+        print(f"Regressions against {args.compare}: {regressions}")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-i', '--images', dest='images',
+                        default='./server/startracker/test_images',
+                        help='Directory with the images to benchmark')
+    parser.add_argument('-o', '--output', required=True, dest='output',
+                        help='Output JSON path')
+    parser.add_argument('-r', '--repeat', dest='repeat', type=int, default=5,
+                        help='Repeats of every stage, the best time is kept')
+    parser.add_argument('-e', '--err', dest='err', type=float, default=0.010,
+                        help='Maximum error for find_stars_pattern')
+    parser.add_argument('-c', '--compare', dest='compare', default=None,
+                        help='Previous results JSON to compare with')
+    parser.add_argument('-t', '--tolerance', dest='tolerance', type=float,
+                        default=0.2, help='Allowed slowdown ratio before a '
+                        'stage is reported as a regression')
+
+    main(parser.parse_args())
@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+"""Compare the full pattern search against frame to frame tracking over a
+sequence of frames, like the ones captured by a burst.
+
+The frames are processed in the order of the number after the last '_' of
+their names, the burst frames are named <burst_id>_<frame>.tiff.
+
+Run it from the startrackerpy directory:
+
+    python -m benchmarks.tracking -i ./server/data/bursts -b 1
+"""
+import argparse
+import os
+import re
+import cv2
+import numpy as np
+from server import catalog
+from server.startracker.pipeline import StarTrackerPipeline
+
+
+def frame_number(filename):
+    """Number of a frame from its file name, 0 if there is none."""
+    match = re.search(r"_(\d+)\.\w+$", filename)
+
+    return int(match.group(1)) if match else 0
+
+
+def run(filenames, tracking, threshold_method):
+    """Returns the pattern times of every frame, the number of frames
+    solved and the number of frames solved by tracking."""
+    pipeline = StarTrackerPipeline(catalog, tracking=tracking)
+    times = []
+    solved = 0
+    tracked = 0
+    for filename in filenames:
+        image = cv2.imread(filename)
+        if len(pipeline.process(image, threshold_method=threshold_method)) > 0:
+            solved += 1
+        tracked += pipeline.tracked
+        times.append(pipeline.timings['pattern'])
+
+    return np.array(times), solved, tracked
+
+
+def main(args):
+    filenames = [filename for filename in os.listdir(args.images)
+                 if args.burst is None or filename.startswith(f"{args.burst}_")]
+    filenames = [f"{args.images}/{filename}"
+                 for filename in sorted(filenames, key=frame_number)]
+    print(f"Frames: {len(filenames)}")
+
+    for tracking, name in [(False, "Full search"), (True, "Tracking")]:
+        times, solved, tracked = run(filenames, tracking, args.threshold_method)
+        print(f"{name}: {solved} solved, {tracked} by tracking, "
+              f"mean {times.mean() * 1000:.2f} ms/frame, "
+              f"max {times.max() * 1000:.2f} ms/frame")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-i', '--images', dest='images',
+                        default='./server/data/bursts',
+                        help='Directory with the sequence of frames')
+    parser.add_argument('-b', '--burst', dest='burst', type=int, default=None,
+                        help='Only use the frames of this burst id')
+    parser.add_argument('-t', '--threshold-method', dest='threshold_method',
+                        default='normal',
+                        choices=['normal', 'sigma_clip', 'otsu', 'triangle'],
+                        help='Automatic threshold method')
+
+    main(parser.parse_args())
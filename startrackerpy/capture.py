@@ -0,0 +1,23 @@
+import argparse
+import logging
+import signal
+import sys
+from server.capture import CaptureDaemon
+
+
+def main(args):
+    logging_format = "%(asctime)s: %(message)s"
+    logging.basicConfig(format=logging_format,
+                        level=logging.INFO,
+                        datefmt="%H:%M:%S")
+    # Release the device and the shared memory when the container stops
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    CaptureDaemon(slots=args.slots).run()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-s', '--slots', dest='slots', type=int, default=8,
+                        help='Number of frames kept in shared memory')
+
+    main(parser.parse_args())
@@ -123,7 +123,7 @@ function getBursts(){
  * Download a burst.
  *
  * @param {Number} burstId ID of the burst to be downloaded.
- * @param {String} format Valid formats are: raw or jpeg.
+ * @param {String} format Valid formats are: tiff, png, webp, npy or jpeg.
  */
 function downloadBurst(burstId, format){
     window.location = `download-burst?burstId=${burstId}&format=${format}`;
@@ -162,6 +162,7 @@ function queueBurst(){
         data: {
             duration: $('#input-duration').val(),
             interval: $('#input-interval').val(),
+            encoding: $('#input-encoding').val(),
             brightness: $("#brightness-input").val(),
             gamma: $("#gamma-input").val(),
             gain: $("#gain-input").val(),
@@ -102,6 +102,15 @@ function processImage(hist_chart){
             html = '<div><span class="badge badge-info">Info</span>';
             html += '<span class="font-weight-bold"> ' +  data.results.stars.msg + '</span></div>';
             $('#logs').append(html);
+            if (data.results.verification) {
+                if (data.results.verification.type == 'info'){
+                    html = '<div><span class="badge badge-info">Info</span>';
+                } else {
+                    html = '<div><span class="badge badge-danger">Error</span>';
+                }
+                html += '<span class="font-weight-bold"> ' +  data.results.verification.msg + '</span></div>';
+                $('#logs').append(html);
+            }
             if (data.results.labeled) {
                 html = '<div><span class="badge badge-info">Info</span>';
                 html += '<span class="font-weight-bold"> ' +  data.results.labeled.msg + '</span></div>';
@@ -117,8 +126,12 @@ function processImage(hist_chart){
         data: {
             uuid: imageUUID,
             auto_threshold: $('#auto-threshold').is(':checked'),
+            threshold_method: $('#threshold-method').val(),
             label_guide_stars: $('#label-guide-stars').is(':checked'),
-            threshold: $('#threshold').val()
+            threshold: $('#threshold').val(),
+            extraction: $('#extraction').val(),
+            subpixel: $('#subpixel').is(':checked'),
+            verify: $('#verify').is(':checked')
         },
         type: "get"
     });
@@ -0,0 +1,39 @@
+#!/usr/bin/env python3
+"""Compile the catalogs CSVs into a bundle of .npy files, which the server
+memory-maps at startup instead of parsing the CSVs:
+
+    python compile_catalog.py -o server/startracker/catalogs/out/catalog_2000_5
+"""
+import argparse
+import time
+from server.startracker.catalog import Catalog
+
+
+def main(args):
+    start = time.perf_counter()
+    catalog = Catalog(args.hip, args.guide_stars, args.labels)
+    catalog.save_bundle(args.output)
+    print(f"CSV catalog compiled in {time.perf_counter() - start:.2f}s")
+
+    start = time.perf_counter()
+    Catalog(bundle=args.output)
+    print(f"Bundle {args.output} loaded in "
+          f"{(time.perf_counter() - start) * 1000:.1f}ms")
+
+
+if __name__ == "__main__":
+    catalogs_path = "./server/startracker/catalogs/out"
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-c', '--hip', dest='hip',
+                        default=f"{catalogs_path}/hip_2000.csv",
+                        help='Propagated Hipparcos catalog CSV path')
+    parser.add_argument('-g', '--guide-stars', dest='guide_stars',
+                        default=f"{catalogs_path}/guide_stars_2000_5.csv",
+                        help='Guide stars pairs CSV path')
+    parser.add_argument('-l', '--labels', dest='labels',
+                        default=f"{catalogs_path}/guide_stars_2000_5_labels.csv",
+                        help='Guide stars labels CSV path')
+    parser.add_argument('-o', '--output', required=True, dest='output',
+                        help='Output bundle directory')
+
+    main(parser.parse_args())
@@ -1,8 +1,8 @@
-from server import jobs
+from server.jobs import Jobs
 
 
 def main():
-    jobs.run()
+    Jobs().run()
 
 
 if __name__ == "__main__":
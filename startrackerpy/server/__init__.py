@@ -1,20 +1,63 @@
-from flask import Flask
-from pathlib import Path
-from influxdb import InfluxDBClient
+"""The objects shared by the server, the InfluxDB client, the catalog and the
+Flask app with its views, are created the first time they are used, so
+importing a module of the package, like server.capture from the capture
+daemon or server.startracker from the scripts, does not create them."""
 import threading
-from server.jobs import Jobs
-from server.startracker.catalog import Catalog
+from pathlib import Path
 
 lock = threading.Lock()
-influx_cli = InfluxDBClient('influxdb', 8086, 'admin', '12345', 'startrackerpy')
 # Probably need to fix this path for docker
 FILE_PATH = Path(__file__).parent.absolute()
 catalogs_path = f"{FILE_PATH}/startracker/catalogs/out"
-catalog = Catalog(f"{catalogs_path}/hip_2000.csv",
-                  f"{catalogs_path}/guide_stars_2000_5.csv",
-                  f"{catalogs_path}/guide_stars_2000_5_labels.csv")
-app = Flask(__name__, template_folder='../client/templates',
-            static_folder='../client/static')
-jobs = Jobs()
-
-from server import views
+# Use the compiled bundle when available, see compile_catalog.py
+catalog_bundle = f"{catalogs_path}/catalog_2000_5"
+
+
+def create_influx_cli():
+    """Returns the client of the metrics database."""
+    from influxdb import InfluxDBClient
+
+    return InfluxDBClient('influxdb', 8086, 'admin', '12345', 'startrackerpy')
+
+
+def load_catalog():
+    """Returns the default catalog, the compiled bundle when available."""
+    from server.startracker.catalog import Catalog
+    if Path(catalog_bundle).is_dir():
+        return Catalog(bundle=catalog_bundle)
+
+    return Catalog(f"{catalogs_path}/hip_2000.csv",
+                   f"{catalogs_path}/guide_stars_2000_5.csv",
+                   f"{catalogs_path}/guide_stars_2000_5_labels.csv")
+
+
+def create_app():
+    """Returns the Flask app with the views registered."""
+    global app
+    from flask import Flask
+    app = Flask(__name__, template_folder='../client/templates',
+                static_folder='../client/static')
+    # The views use the app, so it is set before importing them
+    from server import views
+
+    return app
+
+
+# Functions creating the shared objects, by name
+_factories = {
+    'influx_cli': create_influx_cli,
+    'catalog': load_catalog,
+    'app': create_app,
+}
+_factories_lock = threading.RLock()
+
+
+def __getattr__(name):
+    """Create a shared object the first time it is used."""
+    if name not in _factories:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    with _factories_lock:
+        if name not in globals():
+            globals()[name] = _factories[name]()
+
+    return globals()[name]
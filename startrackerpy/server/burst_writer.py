@@ -0,0 +1,218 @@
+import os
+import time
+import queue
+import logging
+import threading
+import cv2
+import numpy
+from server.db import Db
+
+# Encodings of the burst frames, also the extension of their files
+ENCODINGS = ('tiff', 'png', 'webp', 'npy')
+
+
+def get_frame_path(images_path: str, burst_id: int, frame: int,
+                   encoding: str) -> str:
+    """Path of the file with a burst frame, all the frames of a burst
+    encoded as npy are stored in the same file.
+
+    :param images_path: Directory of the burst images.
+    :param burst_id: ID of the burst.
+    :param frame: Number of the frame, starting at 1.
+    :param encoding: Encoding of the burst, one of ENCODINGS.
+    """
+    if encoding == 'npy':
+        return f"{images_path}/{burst_id}.npy"
+
+    return f"{images_path}/{burst_id}_{frame}.{encoding}"
+
+
+def read_frame(images_path: str, burst_id: int, frame: int, encoding: str,
+               written: set = None) -> numpy.ndarray:
+    """Read a burst frame.
+
+    :param written: Numbers of the frames written, see Db.get_burst_frames.
+    Needed for the npy encoding, as its file has a row for every frame of
+    the burst, written or not.
+    :return: The frame or None if it was not written.
+    """
+    path = get_frame_path(images_path, burst_id, frame, encoding)
+    if not os.path.isfile(path):
+        return None
+    if encoding == 'npy':
+        if written is None or frame not in written:
+            return None
+        return numpy.array(numpy.load(path, mmap_mode='r')[frame - 1])
+
+    return cv2.imread(path)
+
+
+def delete_frames(images_path: str, burst_id: int, frames: int,
+                  encoding: str) -> None:
+    """Delete the files of the frames of a burst.
+    """
+    paths = {get_frame_path(images_path, burst_id, i, encoding)
+             for i in range(1, frames+1)}
+    for path in paths:
+        if os.path.isfile(path):
+            os.remove(path)
+
+
+class BurstWriter:
+    """Pool of threads writing the burst frames taken from a bounded queue,
+    so the capture does not wait for the storage. Writing images releases
+    the GIL, so the threads write several frames at the same time.
+
+    The time the capture waits for room in the queue (backpressure) and
+    the frames dropped because the queue was full are counted for every
+    burst."""
+    def __init__(self, db: Db, workers: int = 2, queue_size: int = 16,
+                 png_level: int = 1):
+        """
+        :param db: Db to write the frames capture time and progress to.
+        :param workers: Number of writer threads.
+        :param queue_size: Maximum frames waiting to be written.
+        :param png_level: PNG compression level, from 0 to 9.
+        """
+        self._db = db
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._png_level = png_level
+        self._lock = threading.Lock()
+        self._bursts = {}
+        for _ in range(workers):
+            threading.Thread(target=self._work, daemon=True).start()
+
+    def start_burst(self, burst_id: int, frames: int, images_path: str,
+                    encoding: str) -> None:
+        """Prepare the writers for a new burst.
+
+        :param burst_id: ID of the burst.
+        :param frames: Number of frames of the burst.
+        :param images_path: Directory of the burst images.
+        :param encoding: Encoding of the frames, one of ENCODINGS.
+        """
+        if encoding not in ENCODINGS:
+            raise ValueError(f"Unknown encoding {encoding}")
+        with self._lock:
+            self._bursts[burst_id] = {
+                'id': burst_id,
+                'frames': frames,
+                'images_path': images_path,
+                'encoding': encoding,
+                'npy': None,
+                'stats': {
+                    'queued': 0,
+                    'written': 0,
+                    'dropped': 0,
+                    'errors': 0,
+                    'backpressure': 0.0,
+                    'max_queue': 0,
+                    'write_time': 0.0,
+                    'max_write_time': 0.0,
+                },
+            }
+
+    def put(self, burst_id: int, frame_number: int, frame: numpy.ndarray,
+            timestamp: float, jitter: float, timeout: float = None) -> bool:
+        """Queue a frame to be written.
+
+        :param burst_id: ID of the burst, see start_burst.
+        :param frame_number: Number of the frame, starting at 1.
+        :param frame: Frame, it must not be modified afterwards.
+        :param timestamp: Unix time when the frame was captured.
+        :param jitter: Seconds between the scheduled and the capture time.
+        :param timeout: Maximum seconds to wait for room in the queue, the
+        frame is dropped after it. None waits until there is room.
+        :return: Whether the frame was queued.
+        """
+        stats = self._bursts[burst_id]['stats']
+        start = time.monotonic()
+        try:
+            self._queue.put((burst_id, frame_number, frame, timestamp, jitter),
+                            timeout=timeout)
+            queued = True
+        except queue.Full:
+            queued = False
+        with self._lock:
+            stats['backpressure'] += time.monotonic() - start
+            stats['max_queue'] = max(stats['max_queue'], self._queue.qsize())
+            if queued:
+                stats['queued'] += 1
+            else:
+                stats['dropped'] += 1
+
+        return queued
+
+    def finish_burst(self, burst_id: int) -> {}:
+        """Wait for the frames of a burst to be written. The frames which
+        were never queued, because their capture failed or the burst was
+        interrupted, are counted as dropped.
+
+        :return: Dictionary with the statistics of the burst.
+        """
+        self._queue.join()
+        with self._lock:
+            burst = self._bursts.pop(burst_id)
+        if burst['npy'] is not None:
+            burst['npy'].flush()
+        stats = burst['stats']
+        stats['dropped'] = burst['frames'] - stats['queued']
+        if stats['written'] > 0:
+            stats['mean_write_time'] = stats['write_time'] / stats['written']
+
+        return stats
+
+    def _write(self, burst, frame_number, frame) -> None:
+        """Encode and write a frame.
+        """
+        encoding = burst['encoding']
+        path = get_frame_path(burst['images_path'], burst['id'], frame_number,
+                              encoding)
+        if encoding == 'npy':
+            # Every frame goes to its row of a file with the whole burst
+            with self._lock:
+                if burst['npy'] is None:
+                    burst['npy'] = numpy.lib.format.open_memmap(
+                        path, mode='w+', dtype=frame.dtype,
+                        shape=(burst['frames'],) + frame.shape)
+            burst['npy'][frame_number - 1] = frame
+            return
+
+        if encoding == 'png':
+            params = [cv2.IMWRITE_PNG_COMPRESSION, self._png_level]
+        elif encoding == 'webp':
+            # Quality above 100 is lossless
+            params = [cv2.IMWRITE_WEBP_QUALITY, 101]
+        else:
+            params = []
+        if not cv2.imwrite(path, frame, params):
+            raise IOError(f"Could not write {path}")
+
+    def _work(self) -> None:
+        """Write the frames of the queue.
+        """
+        while True:
+            burst_id, frame_number, frame, timestamp, jitter = self._queue.get()
+            burst = self._bursts[burst_id]
+            stats = burst['stats']
+            start = time.monotonic()
+            try:
+                self._write(burst, frame_number, frame)
+                self._db.insert_burst_frame(burst_id, frame_number, timestamp,
+                                            jitter)
+                with self._lock:
+                    stats['written'] += 1
+                    elapsed = time.monotonic() - start
+                    stats['write_time'] += elapsed
+                    stats['max_write_time'] = max(stats['max_write_time'], elapsed)
+                    written = stats['written']
+                # The capture marks the burst as finished
+                progress = min(int(written*100/burst['frames']), 99)
+                self._db.update_burst_progress(burst_id, progress)
+            except Exception as e:
+                logging.error(f"Could not write frame {frame_number} of "
+                              f"burst {burst_id}: {e}")
+                with self._lock:
+                    stats['errors'] += 1
+            finally:
+                self._queue.task_done()
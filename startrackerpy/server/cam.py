@@ -1,4 +1,6 @@
 import os
+import json
+import time
 import cv2
 from filelock import FileLock
 import numpy
@@ -6,6 +8,15 @@ import numpy
 
 class Cam():
     """Class to control the camera device
+
+    The device is opened once and kept open while the lock is held, so
+    consecutive reads, like the frames of a burst, reuse the same capture.
+    Releasing the lock releases the device for the other processes.
+
+    The parameters last applied to the device are kept in a file shared by
+    the processes using the lock, so unchanged parameters are not applied
+    again. After a change, the frames are not settled until their mean
+    brightness is stable.
     """
     params_dict = {
         'brightness': cv2.CAP_PROP_BRIGHTNESS,
@@ -14,9 +25,29 @@ class Cam():
         'exposure': cv2.CAP_PROP_EXPOSURE,
     }
 
-    def __init__(self):
+    def __init__(self, settle_tolerance: float = 0.02, settle_frames: int = 2,
+                 settle_max_time: float = 2.0):
+        """
+        :param settle_tolerance: Maximum relative change of the mean
+        brightness between two settled frames.
+        :param settle_frames: Consecutive stable frames needed to consider
+        the parameters settled.
+        :param settle_max_time: Maximum seconds to wait for the frames to
+        settle after changing the parameters.
+        """
         self._id = 0
         self._lock = FileLock("/tmp/cam.lock")
+        self._params_path = "/tmp/cam_params.json"
+        self._capture = None
+        # Parameters applied to the device
+        self._params = {}
+        self._settle_tolerance = settle_tolerance
+        self._settle_frames = settle_frames
+        self._settle_max_time = settle_max_time
+        self._settled = True
+        self._settle_start = 0.0
+        self._settle_mean = None
+        self._stable_frames = 0
 
     def lock_acquire(self, timeout=10) -> None:
         """Acquire a lock to use the camera device
@@ -24,21 +55,109 @@ class Cam():
         :param timeout: Time to wait for the lock; defaults to 10 seconds.
         """
         self._lock.acquire(timeout=timeout)
+        # Another process may have changed the parameters meanwhile
+        if os.path.isfile(self._params_path):
+            with open(self._params_path, 'r') as params_file:
+                self._params = json.load(params_file)
 
     def lock_release(self) -> None:
-        """Release the lock
+        """Release the lock and the camera device
         """
+        self.release()
         self._lock.release()
 
+    def open(self) -> None:
+        """Open the camera device, releasing the current capture if any.
+
+        :raises IOError: If the device can not be opened.
+        """
+        self.release()
+        capture = cv2.VideoCapture(self._id)
+        if not capture.isOpened():
+            capture.release()
+            raise IOError(f"Camera device {self._id} could not be opened")
+        capture.set(cv2.CAP_PROP_BUFFERSIZE, 1)
+        capture.set(cv2.CAP_PROP_AUTO_EXPOSURE, 1.0)
+        self._capture = capture
+
+    def release(self) -> None:
+        """Release the camera device, the next call opens it again. The
+        device keeps its parameters.
+        """
+        if self._capture is not None:
+            self._capture.release()
+        self._capture = None
+
+    def is_opened(self) -> bool:
+        """Whether the camera device is open
+        """
+        return self._capture is not None and self._capture.isOpened()
+
+    def _get_capture(self) -> cv2.VideoCapture:
+        """Returns the open capture, opening the device if needed.
+        """
+        if not self.is_opened():
+            self.open()
+
+        return self._capture
+
+    def _release_unlocked(self) -> None:
+        """Release the device if it was used without the lock, as it is
+        not kept open for other processes to use.
+        """
+        if not self._lock.is_locked:
+            self.release()
+
+    def _update_settle(self, frame) -> None:
+        """Check whether the mean brightness of a new frame is stable.
+        """
+        # Subsampled, the mean of the whole frame is not needed
+        mean = float(frame[::8, ::8].mean())
+        if self._settle_mean is not None and \
+                abs(mean - self._settle_mean) <= max(self._settle_tolerance * self._settle_mean, 0.5):
+            self._stable_frames += 1
+        else:
+            self._stable_frames = 0
+        self._settle_mean = mean
+        self._settled = self._stable_frames >= self._settle_frames or \
+            time.monotonic() - self._settle_start >= self._settle_max_time
+
+    def is_settled(self) -> bool:
+        """Whether the frames read are stable after the last change of
+        the parameters.
+        """
+        return self._settled
+
     def read(self) -> (int, numpy.ndarray):
-        """Returns the cv2 camera object
+        """Returns a frame from the camera. If the read fails the device
+        is opened again, restoring its parameters, and read once more.
+
+        :return: (ret, frame)
+        """
+        ret, frame = self._get_capture().read()
+        if not ret:
+            # Forget the applied parameters so they are all set again
+            params = self._params
+            self._params = {}
+            self.open()
+            capture = self._capture
+            self._apply_params(params)
+            ret, frame = capture.read()
+        if ret and not self._settled:
+            self._update_settle(frame)
+        self._release_unlocked()
+
+        return ret, frame
+
+    def read_settled(self) -> (int, numpy.ndarray):
+        """Returns a frame from the camera, dropping the frames read until
+        the last change of the parameters settled.
 
         :return: (ret, frame)
         """
-        cam = cv2.VideoCapture(self._id)
-        cam.set(cv2.CAP_PROP_BUFFERSIZE, 1)
-        cam.set(cv2.CAP_PROP_AUTO_EXPOSURE, 1.0)
-        ret, frame = cam.read()
+        ret, frame = self.read()
+        while ret and not self._settled:
+            ret, frame = self.read()
 
         return ret, frame
 
@@ -47,24 +166,45 @@ class Cam():
 
         :return: Dictionary with the parameters' values
         """
-        cam = cv2.VideoCapture(self._id)
-        response = {
-            'brightness': cam.get(cv2.CAP_PROP_BRIGHTNESS),
-            'gamma': cam.get(cv2.CAP_PROP_GAMMA),
-            'gain': cam.get(cv2.CAP_PROP_GAIN),
-            'exposure': cam.get(cv2.CAP_PROP_EXPOSURE),
-        }
+        capture = self._get_capture()
+        response = {param: capture.get(prop)
+                    for param, prop in self.params_dict.items()}
+        self._release_unlocked()
 
         return response
 
-    def set_camera_params(self, params) -> None:
-        """Set camera parameters
+    def set_camera_params(self, params) -> bool:
+        """Set camera parameters, only the ones which changed since they
+        were last set are sent to the device.
+
+        :param params: Dictionary with the parameters to set
+        :return: Whether any parameter changed.
+        """
+        changed = self._apply_params(params)
+        self._release_unlocked()
+
+        return changed
+
+    def _apply_params(self, params) -> bool:
+        """Send the changed parameters to the open device, without
+        releasing it.
 
         :param params: Dictionary with the parameters to set
+        :return: Whether any parameter changed.
         """
-        cam = cv2.VideoCapture(self._id)
-        cam.set(cv2.CAP_PROP_BUFFERSIZE, 1)
-        cam.set(cv2.CAP_PROP_AUTO_EXPOSURE, 1.0)
+        changed = False
         for param, value in params.items():
-            if value is not None:
-                cam.set(self.params_dict[param], value)
+            if value is not None and self._params.get(param) != value:
+                self._get_capture().set(self.params_dict[param], value)
+                self._params[param] = value
+                changed = True
+        if changed:
+            self._settled = False
+            self._settle_start = time.monotonic()
+            self._settle_mean = None
+            self._stable_frames = 0
+            if self._lock.is_locked:
+                with open(self._params_path, 'w') as params_file:
+                    json.dump(self._params, params_file)
+
+        return changed
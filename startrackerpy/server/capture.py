@@ -0,0 +1,377 @@
+import mmap
+import os
+import time
+import logging
+import numpy
+from filelock import FileLock
+from server.cam import Cam
+
+RING_NAME = "startrackerpy_frames"
+SHM_PATH = "/dev/shm"
+# Order of the camera parameters stored with every frame
+PARAMS = list(Cam.params_dict)
+
+
+class FrameRing:
+    """Ring buffer with the last frames of the camera in shared memory.
+
+    The capture daemon writes every frame into the next slot together with
+    its sequence number, timestamp, the camera parameters it was taken
+    with and whether they had settled, see Cam.is_settled. Readers map the
+    same memory and use the frames without copying them, a slot being
+    overwritten only after `slots` newer frames.
+
+    The memory is a POSIX shared memory file in /dev/shm, the same ones
+    multiprocessing.shared_memory creates, mapped with mmap so it also
+    works on Python 3.7.
+    """
+    header_dtype = numpy.dtype([
+        ('slots', numpy.int64),
+        ('ndim', numpy.int64),
+        ('shape', numpy.int64, 3),
+        ('seq', numpy.int64),
+        ('heartbeat', numpy.float64),
+        ('request', numpy.float64, len(PARAMS)),
+        ('request_seq', numpy.int64),
+        ('request_priority', numpy.int64),
+        ('request_expires', numpy.float64),
+    ])
+    slot_dtype = numpy.dtype([
+        ('seq', numpy.int64),
+        ('timestamp', numpy.float64),
+        ('params', numpy.float64, len(PARAMS)),
+        ('settled', numpy.bool_),
+    ])
+
+    def __init__(self, name, buffer):
+        """Use FrameRing.create or FrameRing.attach instead.
+
+        :param name: Name of the shared memory.
+        :param buffer: mmap of the shared memory, with the header written.
+        """
+        self._name = name
+        self._buffer = buffer
+        self._lock = FileLock(f"{SHM_PATH}/{name}.lock")
+        self._header = numpy.ndarray(1, self.header_dtype, buffer=buffer)[0]
+        slots = int(self._header['slots'])
+        shape = tuple(self._header['shape'][:self._header['ndim']])
+        slots_offset, frames_offset, _ = self._get_layout(slots, shape)
+        self._slots = numpy.ndarray(slots, self.slot_dtype, buffer=buffer,
+                                    offset=slots_offset)
+        self._frames = numpy.ndarray((slots,) + shape, numpy.uint8,
+                                     buffer=buffer, offset=frames_offset)
+
+    @classmethod
+    def _get_layout(cls, slots, shape) -> (int, int, int):
+        """Offsets of the slots and the frames and size of the memory,
+        every part aligned to 64 bytes.
+        """
+        def align(size):
+            return (size + 63) // 64 * 64
+        slots_offset = align(cls.header_dtype.itemsize)
+        frames_offset = slots_offset + align(slots * cls.slot_dtype.itemsize)
+        size = frames_offset + slots * int(numpy.prod(shape))
+
+        return slots_offset, frames_offset, size
+
+    @classmethod
+    def create(cls, slots, shape, name=RING_NAME) -> 'FrameRing':
+        """Create the shared memory, replacing an existing one.
+
+        The memory is created under a temporary name and renamed into place
+        once its header is written, so the readers still mapping a previous
+        ring keep its memory instead of a truncated file, which would make
+        them crash with SIGBUS, and new readers never see it half written.
+
+        :param slots: Number of frames kept.
+        :param shape: Shape of the uint8 frames.
+        :param name: Name of the shared memory.
+        """
+        _, _, size = cls._get_layout(slots, shape)
+        path = f"{SHM_PATH}/{name}"
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        fd = os.open(tmp_path, os.O_CREAT | os.O_RDWR | os.O_TRUNC, 0o666)
+        try:
+            os.ftruncate(fd, size)
+            buffer = mmap.mmap(fd, size)
+            header = numpy.ndarray(1, cls.header_dtype, buffer=buffer)
+            header['slots'] = slots
+            header['ndim'] = len(shape)
+            header['shape'][0, :len(shape)] = shape
+            header['seq'] = -1
+            header['request'] = numpy.nan
+            header['request_seq'] = 0
+            del header
+            ring = cls(name, buffer)
+            ring._slots['seq'] = -1
+            os.rename(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+        finally:
+            os.close(fd)
+
+        return ring
+
+    @classmethod
+    def attach(cls, name=RING_NAME) -> 'FrameRing':
+        """Map an existing shared memory.
+
+        :param name: Name of the shared memory.
+        :raises FileNotFoundError: If it does not exist.
+        """
+        fd = os.open(f"{SHM_PATH}/{name}", os.O_RDWR)
+        try:
+            buffer = mmap.mmap(fd, 0)
+        finally:
+            os.close(fd)
+
+        return cls(name, buffer)
+
+    @classmethod
+    def attach_running(cls, name=RING_NAME, max_age=2.0):
+        """Map the shared memory of a running capture daemon.
+
+        :param name: Name of the shared memory.
+        :param max_age: Maximum seconds since the last frame was written.
+        :return: FrameRing or None if there is no daemon running.
+        """
+        try:
+            ring = cls.attach(name)
+        except (FileNotFoundError, ValueError):
+            return None
+        if not ring.is_alive(max_age):
+            ring.close()
+            return None
+
+        return ring
+
+    def close(self) -> None:
+        """Unmap the shared memory. The frames returned without copying
+        them must not be used anymore.
+        """
+        self._header = self._slots = self._frames = None
+        self._buffer.close()
+
+    def unlink(self) -> None:
+        """Remove the shared memory, the readers keep their mapping.
+        """
+        os.unlink(f"{SHM_PATH}/{self._name}")
+
+    def is_alive(self, max_age=2.0) -> bool:
+        """Whether a frame was written in the last `max_age` seconds.
+        """
+        return time.time() - self._header['heartbeat'] < max_age
+
+    def latest_seq(self) -> int:
+        """Sequence number of the last frame written, -1 if there is none.
+        """
+        return int(self._header['seq'])
+
+    def is_valid(self, seq) -> bool:
+        """Whether the frame `seq` is still in its slot, to check that a
+        frame used without copying it was not overwritten meanwhile.
+        """
+        return seq >= 0 and int(self._slots[seq % len(self._slots)]['seq']) == seq
+
+    def get(self, seq, copy=True):
+        """Returns a frame of the ring.
+
+        :param seq: Sequence number of the frame.
+        :param copy: Whether to copy the frame, otherwise it is a view of
+        the shared memory, valid until it is overwritten.
+        :return: (timestamp, frame) or None if the frame is not in the ring.
+        """
+        slot = self._slots[seq % len(self._slots)]
+        if int(slot['seq']) != seq:
+            return None
+        timestamp = float(slot['timestamp'])
+        frame = self._frames[seq % len(self._slots)]
+        if copy:
+            frame = frame.copy()
+            if not self.is_valid(seq):
+                return None
+
+        return timestamp, frame
+
+    def get_params(self, seq):
+        """Returns the camera parameters a frame was taken with.
+
+        :param seq: Sequence number of the frame.
+        :return: Dictionary with the known parameters or None if the frame
+        is not in the ring.
+        """
+        slot = self._slots[seq % len(self._slots)]
+        if seq < 0 or int(slot['seq']) != seq:
+            return None
+        params = {param: float(value)
+                  for param, value in zip(PARAMS, slot['params'])
+                  if not numpy.isnan(value)}
+
+        return params if self.is_valid(seq) else None
+
+    def _matches(self, slot, params) -> bool:
+        """Whether a frame slot was taken with the given parameters, any
+        if None, once they settled.
+        """
+        if params is not None:
+            for param, value in zip(PARAMS, slot['params']):
+                if params.get(param) is not None and params[param] != value:
+                    return False
+
+        return bool(slot['settled'])
+
+    def request_params(self, params, priority=0, lease=10.0) -> bool:
+        """Ask the capture daemon to set camera parameters. A request is
+        refused while one with a higher priority has not expired, so a
+        burst keeps its parameters while a preview is taken.
+
+        :param params: Dictionary with the parameters to set.
+        :param priority: Priority of the request.
+        :param lease: Seconds the request keeps its priority, renewed with
+        every request.
+        :return: Whether the parameters were requested.
+        """
+        with self._lock:
+            now = time.time()
+            if priority < self._header['request_priority'] and \
+                    now < self._header['request_expires']:
+                return False
+            if not self._is_requested(params):
+                for i, param in enumerate(PARAMS):
+                    if params.get(param) is not None:
+                        self._header['request'][i] = params[param]
+                self._header['request_seq'] += 1
+            self._header['request_priority'] = priority
+            self._header['request_expires'] = now + lease
+
+        return True
+
+    def release_params(self, priority) -> None:
+        """Let requests with a lower priority change the parameters again.
+
+        :param priority: Priority of the released request.
+        """
+        with self._lock:
+            if self._header['request_priority'] == priority:
+                self._header['request_expires'] = 0
+
+    def _is_requested(self, params) -> bool:
+        """Whether the last request includes the given parameters.
+        """
+        return all(params.get(param) is None or params[param] == value
+                   for param, value in zip(PARAMS, self._header['request']))
+
+    def wait_frame(self, params=None, after=-1, timeout=10, copy=True,
+                   priority=0, lease=10.0):
+        """Wait for a new settled frame taken with the given camera
+        parameters, requesting them if another reader changed them. If a
+        request with a higher priority holds other parameters, the frame
+        is taken with those instead of changing them.
+
+        :param params: Dictionary with the camera parameters of the frame,
+        None for any frame.
+        :param after: Sequence number the frame must be newer than, by
+        default the latest frame is valid.
+        :param timeout: Seconds to wait for the frame.
+        :param copy: Whether to copy the frame, see get.
+        :param priority: Priority of the request, see request_params.
+        :param lease: Seconds the request keeps its priority.
+        :return: (seq, timestamp, frame)
+        :raises TimeoutError: If no frame arrived in time.
+        """
+        deadline = time.time() + timeout
+        requested = params is None or self.request_params(params, priority, lease)
+        while time.time() < deadline:
+            if params is not None and not self._is_requested(params):
+                requested = self.request_params(params, priority, lease)
+            seq = self.latest_seq()
+            if seq > after and self._matches(self._slots[seq % len(self._slots)],
+                                             params if requested else None):
+                frame = self.get(seq, copy)
+                if frame is not None:
+                    return (seq,) + frame
+            time.sleep(0.005)
+
+        raise TimeoutError("No frame received from the capture daemon")
+
+    def get_request(self) -> (int, {}):
+        """Returns the parameters requested by the readers.
+
+        :return: (request_seq, params), the sequence number changes with
+        every request.
+        """
+        with self._lock:
+            request = {param: float(value)
+                       for param, value in zip(PARAMS, self._header['request'])
+                       if not numpy.isnan(value)}
+            return int(self._header['request_seq']), request
+
+    def write(self, frame, params, settled) -> int:
+        """Write a frame into the next slot.
+
+        :param frame: uint8 frame with the shape of the ring.
+        :param params: Dictionary with the camera parameters of the frame.
+        :param settled: Whether the parameters had settled.
+        :return: Sequence number of the frame.
+        """
+        seq = self.latest_seq() + 1
+        index = seq % len(self._slots)
+        slot = self._slots[index]
+        # Readers discard the slot while it is being written
+        slot['seq'] = -1
+        self._frames[index] = frame
+        slot['timestamp'] = time.time()
+        slot['params'] = [params.get(param, numpy.nan) for param in PARAMS]
+        slot['settled'] = settled
+        slot['seq'] = seq
+        self._header['seq'] = seq
+        self._header['heartbeat'] = slot['timestamp']
+
+        return seq
+
+
+class CaptureDaemon:
+    """Owns the camera device and publishes every frame into a FrameRing,
+    so any number of processes can use the frames at the same time. The
+    camera parameters are set when a reader requests them."""
+    def __init__(self, slots: int = 8, name: str = RING_NAME):
+        self._cam = Cam()
+        self._slots = slots
+        self._name = name
+
+    def run(self) -> None:
+        """Capture frames until the process is stopped.
+        """
+        logging.info("Starting capture daemon")
+        # Keep the device for this process while it runs
+        self._cam.lock_acquire(timeout=-1)
+        ring = None
+        request_seq = 0
+        # Parameters of the device until a reader requests others
+        params = self._cam.get_camera_params()
+        try:
+            while True:
+                if ring is not None:
+                    seq, request = ring.get_request()
+                    if seq != request_seq:
+                        request_seq = seq
+                        self._cam.set_camera_params(request)
+                        params = dict(params, **request)
+                ret, frame = self._cam.read()
+                if not ret:
+                    logging.warning("Could not read a frame from the camera")
+                    time.sleep(0.1)
+                    continue
+                if ring is None:
+                    ring = FrameRing.create(self._slots, frame.shape, self._name)
+                    logging.info(f"Publishing {frame.shape} frames in "
+                                 f"{SHM_PATH}/{self._name}")
+                ring.write(frame, params, self._cam.is_settled())
+        except KeyboardInterrupt:
+            print("Manual break by user")
+        finally:
+            if ring is not None:
+                ring.unlink()
+                ring.close()
+            self._cam.lock_release()
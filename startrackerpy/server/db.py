@@ -20,11 +20,32 @@ class Db:
         brightness integer, gamma integer, gain integer, exposure integer,
         progress integer default 0, inserted timestamp default (datetime('now','localtime')),
         updated timestamp default null, finished timestamp default null)''')
+        # Columns added after the table was created
+        columns = [row[1] for row in c.execute("PRAGMA table_info(burst)")]
+        for column, definition in [('encoding', "text default 'tiff'"),
+                                   ('dropped', "integer default 0"),
+                                   ('backpressure', "real default 0")]:
+            if column not in columns:
+                c.execute(f"ALTER TABLE burst ADD COLUMN {column} {definition}")
+        c.execute('''CREATE TABLE IF NOT EXISTS burst_frame
+        (burst_id integer, frame integer, timestamp real, jitter real,
+        primary key (burst_id, frame))''')
+        # Pointing of the frame, filled once the burst is solved
+        columns = [row[1] for row in c.execute("PRAGMA table_info(burst_frame)")]
+        for column, definition in [('solved', "integer default null"),
+                                   ('tracked', "integer default null"),
+                                   ('ra', "real default null"),
+                                   ('dec', "real default null"),
+                                   ('roll', "real default null"),
+                                   ('solve_time', "real default null")]:
+            if column not in columns:
+                c.execute(f"ALTER TABLE burst_frame ADD COLUMN {column} {definition}")
         conn.commit()
         conn.close()
 
     def insert_burst(self, duration: int, interval: int, brightness: int,
-                     gamma: int, gain: int, exposure: int) -> int:
+                     gamma: int, gain: int, exposure: int,
+                     encoding: str = 'tiff') -> int:
         """Insert a burst in the DB
 
         :param duration: Duration of the burst in seconds
@@ -33,15 +54,17 @@ class Db:
         :param gamma: Gamma value to set to the camera
         :param gain: Gain value to set to the camera
         :param exposure: Exposure value to set to the camera
+        :param encoding: Encoding of the frames, see burst_writer.ENCODINGS
 
         :return: ID of the row inserted
         """
         conn = sqlite3.connect(self._db)
         c = conn.cursor()
         c.execute(
-            """INSERT INTO burst(duration, interval, brightness, gamma, gain, exposure)
-            VALUES(?,?,?,?,?,?)
-            """, (duration, interval, brightness, gamma, gain, exposure))
+            """INSERT INTO burst(duration, interval, brightness, gamma, gain, exposure,
+            encoding)
+            VALUES(?,?,?,?,?,?,?)
+            """, (duration, interval, brightness, gamma, gain, exposure, encoding))
         conn.commit()
         conn.close()
 
@@ -90,6 +113,7 @@ class Db:
         conn.row_factory = sqlite3.Row
         c = conn.cursor()
         c.execute("DELETE from burst WHERE id=?", str(burst_id))
+        c.execute("DELETE from burst_frame WHERE burst_id=?", (burst_id,))
         conn.commit()
         conn.close()
 
@@ -111,3 +135,75 @@ class Db:
         c.execute(query)
         conn.commit()
         conn.close()
+
+    def update_burst_stats(self, burst_id: int, dropped: int,
+                           backpressure: float) -> None:
+        """Update the writer statistics of a burst
+
+        :param burst_id: ID of the burst to be updated
+        :param dropped: Frames dropped because the writers were behind
+        :param backpressure: Seconds the capture waited for the writers
+        """
+        conn = sqlite3.connect(self._db)
+        c = conn.cursor()
+        c.execute("UPDATE burst SET dropped=?, backpressure=? WHERE id=?",
+                  (dropped, backpressure, burst_id))
+        conn.commit()
+        conn.close()
+
+    def insert_burst_frame(self, burst_id: int, frame: int, timestamp: float,
+                           jitter: float) -> None:
+        """Insert the capture time of a burst frame
+
+        :param burst_id: ID of the burst
+        :param frame: Number of the frame, starting at 1
+        :param timestamp: Unix time when the frame was captured
+        :param jitter: Seconds between the scheduled and the capture time
+        """
+        conn = sqlite3.connect(self._db)
+        c = conn.cursor()
+        c.execute(
+            """INSERT OR REPLACE INTO burst_frame(burst_id, frame, timestamp, jitter)
+            VALUES(?,?,?,?)
+            """, (burst_id, frame, timestamp, jitter))
+        conn.commit()
+        conn.close()
+
+    def update_burst_frame_solution(self, burst_id: int, frame: int,
+                                    solved: bool, tracked: bool, pointing,
+                                    solve_time: float) -> None:
+        """Update the solution of a burst frame
+
+        :param burst_id: ID of the burst
+        :param frame: Number of the frame, starting at 1
+        :param solved: Whether the stars pattern of the frame was found
+        :param tracked: Whether it was found by tracking the previous frame
+        :param pointing: (ra, dec, roll) of the camera in degrees, or None
+        :param solve_time: Seconds spent solving the frame
+        """
+        ra, dec, roll = pointing if pointing is not None else (None, None, None)
+        conn = sqlite3.connect(self._db)
+        c = conn.cursor()
+        c.execute(
+            """UPDATE burst_frame SET solved=?, tracked=?, ra=?, dec=?, roll=?,
+            solve_time=? WHERE burst_id=? AND frame=?
+            """, (solved, tracked, ra, dec, roll, solve_time, burst_id, frame))
+        conn.commit()
+        conn.close()
+
+    def get_burst_frames(self, burst_id: int) -> []:
+        """Retrieve the capture times and the solutions of the frames of a burst
+
+        :param burst_id: ID of the burst
+
+        :return: Rows of the frames, sorted by frame number
+        """
+        conn = sqlite3.connect(self._db)
+        conn.row_factory = sqlite3.Row
+        c = conn.cursor()
+        c.execute("SELECT * from burst_frame WHERE burst_id=? ORDER BY frame",
+                  (burst_id,))
+        res = [r for r in c]
+        conn.close()
+
+        return res
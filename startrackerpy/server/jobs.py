@@ -5,17 +5,39 @@ from pathlib import Path
 from datetime import datetime
 import cv2
 from influxdb import InfluxDBClient
+import server
 from server.sensors import CPU_SENSOR, DS1621, LSM303
 from server.db import Db
 from server.cam import Cam
+from server.capture import FrameRing
+from server.burst_writer import BurstWriter, read_frame
+from server.startracker.pipeline import StarTrackerPipeline
+
+# Priority of the burst camera parameters over the preview ones
+BURST_PRIORITY = 1
 
 
 class Jobs:
     """Class to run background jobs every `interval` seconds
-    it is mainly used to capture a burst of images and to gather
-    sensors metrics."""
-    def __init__(self, interval: int = 5):
+    it is mainly used to capture a burst of images, to solve its frames
+    and to gather sensors metrics."""
+    def __init__(self, interval: int = 5, burst_queue_size: int = 16,
+                 burst_writers: int = 2, png_level: int = 1,
+                 solve_bursts: bool = True):
+        """
+        :param interval: Seconds between metrics and bursts checks.
+        :param burst_queue_size: Maximum burst frames waiting to be
+        written, the capture waits when it is full.
+        :param burst_writers: Number of threads writing the burst frames.
+        :param png_level: PNG compression level of the bursts encoded as PNG.
+        :param solve_bursts: Find the pointing of the burst frames once
+        they are captured.
+        """
         self._interval = interval
+        self._burst_queue_size = burst_queue_size
+        self._burst_writers = burst_writers
+        self._png_level = png_level
+        self._solve_bursts = solve_bursts
 
     @classmethod
     def __write_cpu_metrics(cls, influx_cli: InfluxDBClient,
@@ -146,6 +168,123 @@ class Jobs:
         except KeyboardInterrupt:
             print("Manual break by user")
 
+    @classmethod
+    def __capture_burst(cls, burst, db: Db, cam: Cam, writer: BurstWriter,
+                        images_path: str) -> None:
+        """Capture the frames of a burst. The frames are scheduled at
+        absolute times from the start of the burst with the monotonic
+        clock, so the time spent capturing does not delay the next frames.
+        A frame is dropped if the writers are so far behind that waiting
+        for them would delay the next one, or if it can not be captured.
+        The burst is always finished, even if the capture fails.
+
+        :param burst: Row of the burst.
+        :param db: Db to write the burst statistics to.
+        :param cam: Cam used when the capture daemon is not running.
+        :param writer: BurstWriter writing the frames.
+        :param images_path: Directory of the burst images.
+        """
+        logging.debug(f"Starting burst {burst['id']}")
+        frames = int(burst['duration'] / burst['interval'])
+        cam_params = {
+            'brightness': int(burst['brightness']),
+            'gamma': int(burst['gamma']),
+            'gain': int(burst['gain']),
+            'exposure': int(burst['exposure']),
+        }
+        # The frames not captured are counted as dropped, see finish_burst
+        writer.start_burst(burst['id'], frames, images_path, burst['encoding'])
+        ring = None
+        try:
+            # Use the capture daemon frames when it is running
+            ring = FrameRing.attach_running()
+            if ring is None:
+                cam.lock_acquire()
+                cam.set_camera_params(cam_params)
+            start = time.monotonic()
+            start_time = time.time()
+            for i in range(1, frames+1):
+                deadline = (i - 1) * burst['interval']
+                delay = start + deadline - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+                try:
+                    if ring is not None:
+                        # First frame captured after the deadline
+                        _, timestamp, frame = ring.wait_frame(
+                            cam_params, after=ring.latest_seq(),
+                            priority=BURST_PRIORITY,
+                            lease=burst['interval'] + 10)
+                    else:
+                        ret, frame = cam.read_settled()
+                        if not ret:
+                            raise IOError("Could not read a frame from the camera")
+                        timestamp = time.time()
+                except Exception as e:
+                    logging.error(f"Could not capture frame {i} of burst "
+                                  f"{burst['id']}: {e}")
+                    continue
+                jitter = timestamp - (start_time + deadline)
+                next_deadline = start + deadline + burst['interval']
+                writer.put(burst['id'], i, frame, timestamp, jitter,
+                           timeout=max(next_deadline - time.monotonic(), 0))
+        finally:
+            if ring is not None:
+                ring.release_params(BURST_PRIORITY)
+                ring.close()
+            else:
+                cam.lock_release()
+            # The burst is finished once all its frames are written
+            stats = writer.finish_burst(burst['id'])
+            db.update_burst_stats(burst['id'], stats['dropped'],
+                                  stats['backpressure'])
+            db.update_burst_progress(burst['id'], 100)
+            logging.info(f"Burst {burst['id']} finished: {stats['written']} "
+                         f"frames written, {stats['dropped']} dropped, "
+                         f"{stats['errors']} errors, "
+                         f"{stats['backpressure']:.2f}s of backpressure, "
+                         f"queue up to {stats['max_queue']} frames, "
+                         f"{stats.get('mean_write_time', 0) * 1000:.1f}ms "
+                         "per write")
+
+    @classmethod
+    def __solve_burst(cls, burst, db: Db, pipeline: StarTrackerPipeline,
+                      images_path: str) -> None:
+        """Solve the frames of a burst in order. The stars identified in a
+        frame are tracked in the next one, so the full pattern search only
+        runs for the first frame, after a dropped frame and when the
+        tracked stars are lost.
+
+        :param burst: Row of the burst.
+        :param db: Db to write the pointing of the frames to.
+        :param pipeline: StarTrackerPipeline with tracking enabled.
+        :param images_path: Directory of the burst images.
+        """
+        frames = db.get_burst_frames(burst['id'])
+        written = {frame['frame'] for frame in frames}
+        solved = 0
+        tracked = 0
+        previous = 0
+        pipeline.reset_tracking()
+        for frame in frames:
+            image = read_frame(images_path, burst['id'], frame['frame'],
+                               burst['encoding'], written)
+            if image is None:
+                continue
+            # The stars can not be tracked over a dropped frame
+            if frame['frame'] != previous + 1:
+                pipeline.reset_tracking()
+            previous = frame['frame']
+            pattern = pipeline.process(image)
+            db.update_burst_frame_solution(burst['id'], frame['frame'],
+                                           len(pattern) > 0, pipeline.tracked,
+                                           pipeline.get_pointing(),
+                                           sum(pipeline.timings.values()))
+            solved += len(pattern) > 0
+            tracked += pipeline.tracked
+        logging.info(f"Burst {burst['id']} solved: {solved} of {len(frames)} "
+                     f"frames, {tracked} by tracking")
+
     def __check_bursts(self) -> None:
         """ Check for burst to be processed every `interval` seconds.
         """
@@ -155,31 +294,31 @@ class Jobs:
         cam = Cam()
         images_path = f"{FILE_PATH}/data/bursts"
         Path(images_path).mkdir(parents=True, exist_ok=True)
+        writer = BurstWriter(db, workers=self._burst_writers,
+                             queue_size=self._burst_queue_size,
+                             png_level=self._png_level)
+        # Created with the first burst solved, as it loads the catalog
+        pipeline = None
 
         while True:
             bursts = db.get_bursts()
             for burst in bursts:
                 if burst['finished'] is not None:
                     continue
-
-                logging.debug(f"Starting burst {burst['id']}")
-                frames = int(burst['duration'] / burst['interval'])
-                cam_params = {
-                    'brightness': int(burst['brightness']),
-                    'gamma': int(burst['gamma']),
-                    'gain': int(burst['gain']),
-                    'exposure': int(burst['exposure']),
-                }
-                cam.lock_acquire()
-                cam.set_camera_params(cam_params)
-                for i in range(1, frames+1):
-                    _, frame = cam.read()
-                    img_name = "{}/{}_{}.tiff".format(images_path,
-                                                      burst['id'], i)
-                    cv2.imwrite(img_name, frame)
-                    db.update_burst_progress(burst['id'], int(i*100/frames))
-                    time.sleep(burst['interval'])
-                cam.lock_release()
+                try:
+                    self.__capture_burst(burst, db, cam, writer, images_path)
+                except Exception:
+                    # Keep the thread alive for the next bursts
+                    logging.exception(f"Burst {burst['id']} failed")
+                    continue
+                if not self._solve_bursts:
+                    continue
+                try:
+                    if pipeline is None:
+                        pipeline = StarTrackerPipeline(server.catalog, tracking=True)
+                    self.__solve_burst(burst, db, pipeline, images_path)
+                except Exception:
+                    logging.exception(f"Burst {burst['id']} could not be solved")
 
             time.sleep(self._interval)
 
@@ -2,35 +2,83 @@
 import csv
 import json
 import copy
+from pathlib import Path
 import numpy as np
+from scipy.spatial import cKDTree
 from server.startracker.star import Star
 from server.startracker.image_star import ImageStar
 
+# Columns of the main catalog table
+STARS_DTYPE = np.dtype([('hip', np.int32), ('ra', np.float64),
+                        ('dec', np.float64), ('promora', np.float64),
+                        ('promodec', np.float64), ('parallax', np.float64),
+                        ('vmag', np.float64)])
+
+# Files of a compiled catalog bundle, see Catalog.save_bundle
+BUNDLE_FILES = ['stars', 'hip_rows', 'named_rows', 'names',
+                'guide_stars_catalog', 'guide_distances', 'guide_stars',
+                'pair_keys', 'pair_rows', 'unit_vectors']
+
+
 class Catalog:
-    def __init__(self, hip_csv, guide_stars_csv, guide_stars_labels_csv=None,
-                 guide_neighbours_json=None):
-        self._hip_catalog = {}
+    def __init__(self, hip_csv=None, guide_stars_csv=None,
+                 guide_stars_labels_csv=None, guide_neighbours_json=None,
+                 bundle=None):
+        self._stars = []
+        self._hip_rows = []
+        self._named_rows = []
+        self._names = []
+        self._name_index = None
+        self._unit_vectors = []
+        self._tree = None
         self._guide_stars = []
         self._guide_stars_catalog = []
+        self._guide_distances = []
+        self._pair_keys = []
+        self._pair_rows = []
         self._guide_neighbours_catalog = {}
         self._fov_catalog = []
-        self._load_hip_catalog(hip_csv)
-        self._load_guide_stars_catalog(guide_stars_csv)
-        self._label_guide_stars(guide_stars_labels_csv)
+        if bundle is not None:
+            self._load_bundle(bundle)
+        else:
+            self._load_hip_catalog(hip_csv)
+            self._load_guide_stars_catalog(guide_stars_csv)
+            self._label_guide_stars(guide_stars_labels_csv)
         if guide_neighbours_json is not None:
             self._load_guide_neighbours_catalog(guide_neighbours_json)
         # self.generate_fov_catalog()
 
     def _load_hip_catalog(self, hip_csv):
-        """Main catalog in a dictionary and a Star object"""
+        """Main catalog in a table sorted by HIP number, with a lookup array
+        from HIP number to row"""
+        rows = []
         with open(hip_csv, 'r') as csv_file:
             csv_reader = csv.DictReader(csv_file)
             for row in csv_reader:
-                star = Star(row['HIP_number'], float(row['ra_degrees']),
-                            float(row['dec_degrees']), row['promora'],
-                            row['promodec'], row['parallax'],
-                            float(row['vmag']))
-                self._hip_catalog[row['HIP_number']] = star
+                rows.append((int(row['HIP_number']), float(row['ra_degrees']),
+                             float(row['dec_degrees']), float(row['promora']),
+                             float(row['promodec']), float(row['parallax']),
+                             float(row['vmag'])))
+        stars = np.array(rows, dtype=STARS_DTYPE)
+        self._stars = stars[np.argsort(stars['hip'], kind='stable')]
+        self._hip_rows = np.full(self._stars['hip'].max() + 1, -1, dtype=np.int32)
+        self._hip_rows[self._stars['hip']] = np.arange(len(self._stars))
+        self._named_rows = np.zeros(0, dtype=np.int32)
+        self._names = np.zeros(0, dtype='U1')
+        self._unit_vectors = self._compute_unit_vectors(self._stars['ra'],
+                                                        self._stars['dec'])
+
+    @classmethod
+    def _compute_unit_vectors(cls, ra, dec):
+        """Converts the given ra and dec arrays to cartesian coordinates,
+        as Star.get_cartesian_coords does.
+
+        :return: (N, 3) float64 array"""
+        dec = np.deg2rad(np.asarray(dec) + 90)
+        ra = np.deg2rad(np.asarray(ra))
+
+        return np.stack([np.sin(dec) * np.cos(ra), np.sin(dec) * np.sin(ra),
+                         np.cos(dec)], axis=1)
 
     def _load_guide_stars_catalog(self, guide_stars_csv):
         lst = []
@@ -41,14 +89,109 @@ class Catalog:
                 hip_b = int(row["HIP_number_b"])
                 distance = float(row["distance"])
                 lst.append([hip_a, hip_b, distance])
-        self._guide_stars_catalog = np.array(lst)
+        guide_stars_catalog = np.array(lst)
+        # Keep the pairs sorted by distance, the distance column is
+        # used as the index for the range queries
+        order = np.argsort(guide_stars_catalog[:, 2], kind='stable')
+        self._guide_stars_catalog = guide_stars_catalog[order]
+        self._guide_distances = np.ascontiguousarray(self._guide_stars_catalog[:, 2])
         self._guide_stars = np.unique(self._guide_stars_catalog[:, :-1])
+        self._build_pair_index()
+
+    def _build_pair_index(self):
+        """Index the guide pairs by their packed (min_hip, max_hip) key, so
+        checking if two stars form a pair is a binary search."""
+        hip_numbers = self._guide_stars_catalog[:, :-1].astype(np.int64)
+        keys = self._pack_pair_keys(hip_numbers[:, 0], hip_numbers[:, 1])
+        self._pair_rows = np.argsort(keys, kind='stable')
+        self._pair_keys = keys[self._pair_rows]
+
+    @classmethod
+    def _pack_pair_keys(cls, hip_a, hip_b):
+        """Returns a 64 bits key for the pairs of HIP numbers, no matter the
+        order of the stars in the pair."""
+        hip_a = np.asarray(hip_a, dtype=np.int64)
+        hip_b = np.asarray(hip_b, dtype=np.int64)
+
+        return (np.minimum(hip_a, hip_b) << 32) | np.maximum(hip_a, hip_b)
 
     def _label_guide_stars(self, guide_stars_labels_csv):
+        """Names of the labeled stars, sorted by their row in the main
+        catalog table"""
+        if guide_stars_labels_csv is None:
+            return
+        hip_numbers = []
+        names = []
         with open(guide_stars_labels_csv, 'r') as csv_file:
             csv_reader = csv.DictReader(csv_file)
             for row in csv_reader:
-                self._hip_catalog[row['HIP_number']].set_name(row['Name'])
+                hip_numbers.append(int(row['HIP_number']))
+                names.append(row['Name'])
+        names = np.array(names, dtype=str)
+        rows = self._get_rows(hip_numbers)
+        rows, unique = np.unique(rows, return_index=True)
+        names = names[unique]
+        self._named_rows = rows[rows >= 0].astype(np.int32)
+        self._names = names[rows >= 0]
+
+    def _load_bundle(self, bundle_path):
+        """Load a compiled catalog bundle. Its arrays are memory-mapped in
+        read-only mode, so they are shared by all the processes using the
+        same bundle."""
+        arrays = {}
+        for name in BUNDLE_FILES:
+            arrays[name] = np.load(f"{bundle_path}/{name}.npy", mmap_mode='r')
+        self._stars = arrays['stars']
+        self._hip_rows = arrays['hip_rows']
+        self._named_rows = arrays['named_rows']
+        self._names = arrays['names']
+        self._guide_stars_catalog = arrays['guide_stars_catalog']
+        self._guide_distances = arrays['guide_distances']
+        self._guide_stars = arrays['guide_stars']
+        self._pair_keys = arrays['pair_keys']
+        self._pair_rows = arrays['pair_rows']
+        self._unit_vectors = arrays['unit_vectors']
+
+    def save_bundle(self, bundle_path):
+        """Save the catalog as a bundle of .npy files which can be loaded
+        with Catalog(bundle=bundle_path).
+
+        :param bundle_path: Directory to write the bundle to."""
+        Path(bundle_path).mkdir(parents=True, exist_ok=True)
+        arrays = {
+            'stars': self._stars,
+            'hip_rows': self._hip_rows,
+            'named_rows': self._named_rows,
+            'names': self._names,
+            'guide_stars_catalog': self._guide_stars_catalog,
+            'guide_distances': self._guide_distances,
+            'guide_stars': self._guide_stars,
+            'pair_keys': self._pair_keys,
+            'pair_rows': self._pair_rows,
+            'unit_vectors': self._unit_vectors,
+        }
+        for name in BUNDLE_FILES:
+            np.save(f"{bundle_path}/{name}.npy",
+                    np.ascontiguousarray(arrays[name]))
+
+    def _get_rows(self, hip_numbers):
+        """Returns the rows of the main catalog table for the given HIP
+        numbers, -1 for the ones not in the catalog."""
+        hip_numbers = np.asarray(hip_numbers, dtype=np.int64)
+        in_range = (hip_numbers >= 0) & (hip_numbers < len(self._hip_rows))
+        rows = np.full(hip_numbers.shape, -1, dtype=np.int64)
+        rows[in_range] = self._hip_rows[hip_numbers[in_range]]
+
+        return rows
+
+    def _get_name(self, row):
+        """Returns the name of the star in the given row, empty if it has
+        no name."""
+        i = np.searchsorted(self._named_rows, row)
+        if i < len(self._named_rows) and self._named_rows[i] == row:
+            return str(self._names[i])
+
+        return ""
 
     def _load_guide_neighbours_catalog(self, json_file_path):
         with open(json_file_path, 'r') as json_file:
@@ -61,9 +204,9 @@ class Catalog:
             if len(self._guide_neighbours_catalog[star_id]) < 3:
                 continue
 
-            star = self._hip_catalog[star_id]
+            star = self.get_star_by_id(star_id)
             for neighbour in self._guide_neighbours_catalog[star_id]:
-                star.add_neighbour(self._hip_catalog[neighbour])
+                star.add_neighbour(self.get_star_by_id(neighbour))
 
             # Get the three most brightness neighbours
             most_brightness = self.get_most_brightness(star)
@@ -102,25 +245,87 @@ class Catalog:
 
     def get_star_by_id(self, hip_number):
         """Given a HIP number ID, returns its Star object"""
-        if str(hip_number) in self._hip_catalog:
-            return self._hip_catalog[str(hip_number)]
-
-        return None
+        row = self._get_rows([int(hip_number)])[0]
+        if row < 0:
+            return None
+
+        return self._get_star(row)
+
+    def get_star_by_name(self, name):
+        """Given a star name, returns its Star object"""
+        if self._name_index is None:
+            self._name_index = {str(name): int(row) for row, name
+                                in zip(self._named_rows, self._names)}
+        if name not in self._name_index:
+            return None
+
+        return self._get_star(self._name_index[name])
+
+    def _get_star(self, row):
+        """Star objects are lightweight views built on demand from the
+        catalog table, they are not kept by the catalog."""
+        fields = self._stars[row]
+        star = Star(str(fields['hip']), float(fields['ra']),
+                    float(fields['dec']), float(fields['promora']),
+                    float(fields['promodec']), float(fields['parallax']),
+                    float(fields['vmag']), self._unit_vectors[row])
+        star.set_name(self._get_name(row))
+
+        return star
+
+    def cone_search(self, ra, dec, radius, max_vmag=None):
+        """Returns the stars within an angular distance of a pointing. The
+        KD-tree of the catalog unit vectors is built on the first search.
+
+        :param ra: Right ascension of the cone center in degrees.
+        :param dec: Declination of the cone center in degrees.
+        :param radius: Radius of the cone in degrees.
+        :param max_vmag: Only return the stars brighter than this magnitude.
+        :return: Rows of the catalog table, sorted by magnitude."""
+        if self._tree is None:
+            self._tree = cKDTree(self._unit_vectors)
+
+        center = self._compute_unit_vectors([ra], [dec])[0]
+        # Distance between unit vectors of the chord of the radius angle
+        chord = 2 * np.sin(np.radians(min(radius, 180)) / 2)
+        rows = np.array(self._tree.query_ball_point(center, chord), dtype=np.int64)
+        vmag = self._stars['vmag'][rows]
+        if max_vmag is not None:
+            rows = rows[vmag < max_vmag]
+            vmag = vmag[vmag < max_vmag]
+
+        return rows[np.argsort(vmag, kind='stable')]
 
     def get_pairs_by_distance(self, a, b):
         """Returns the pairs for which their angular distance
         is greater than a and lower than b"""
-        pairs = []
-        condition = (self._guide_stars_catalog[:, 2] > a) & \
-            (self._guide_stars_catalog[:, 2] < b)
-        indices = np.where(condition)
-        for i in indices[0]:
-            pairs.append([int(self._guide_stars_catalog[i][0]),
-                          int(self._guide_stars_catalog[i][1]),
-                          float(self._guide_stars_catalog[i][2])])
+        start, end = self._get_pairs_range(a, b)
+        pairs = [[int(hip_a), int(hip_b), distance] for hip_a, hip_b, distance
+                 in self._guide_stars_catalog[start:end].tolist()]
 
         return pairs
 
+    def _get_pairs_range(self, a, b):
+        """Returns the [start, end) rows of the guide stars catalog for which
+        their angular distance is greater than a and lower than b.
+
+        As the catalog is sorted by distance, both limits are found with
+        a binary search: O(log n)."""
+        start = np.searchsorted(self._guide_distances, a, side='right')
+        end = np.searchsorted(self._guide_distances, b, side='left')
+
+        return int(start), int(max(start, end))
+
+    def get_pair_distance(self, hip_a, hip_b):
+        """Returns the angular distance of the guide pair formed by the
+        given HIP numbers, None if they are not a guide pair."""
+        key = self._pack_pair_keys(int(hip_a), int(hip_b))
+        i = np.searchsorted(self._pair_keys, key)
+        if i < len(self._pair_keys) and self._pair_keys[i] == key:
+            return float(self._guide_stars_catalog[self._pair_rows[i]][2])
+
+        return None
+
     @classmethod
     def get_most_brightness(cls, star):
         """Given a start returns the three more brightness stars
@@ -145,47 +350,95 @@ class Catalog:
         err2 = d_star1_star3 * err
         err3 = d_star2_star3 * err
 
-        pairs_a_b = self.get_pairs_by_distance(d_star1_star2-err1, d_star1_star2+err1)
-        pairs_a_c = self.get_pairs_by_distance(d_star1_star3-err2, d_star1_star3+err2)
+        pairs_a_b = self._get_pairs_hips(d_star1_star2-err1, d_star1_star2+err1)
+        pairs_a_c = self._get_pairs_hips(d_star1_star3-err2, d_star1_star3+err2)
 
         # For each star present in both pairs AB and AC
         # Check if the other two stars are in range of
-        # distance BC star2_star3
-        for pair1 in pairs_a_b:
-            for pair2 in pairs_a_c:
-                hip_both = None  # This is the star present in both pairs
-                if pair1[0] == pair2[0]:
-                    hip_both = pair1[0]
-                    hip_x = pair1[1]
-                    hip_y = pair2[1]
-                elif pair1[0] == pair2[1]:
-                    hip_both = pair1[0]
-                    hip_x = pair1[1]
-                    hip_y = pair2[0]
-                elif pair1[1] == pair2[0]:
-                    hip_both = pair1[1]
-                    hip_x = pair1[0]
-                    hip_y = pair2[1]
-                elif pair1[1] == pair2[1]:
-                    hip_both = pair1[1]
-                    hip_x = pair1[0]
-                    hip_y = pair2[0]
-                else:
-                    continue
-
-                star_x = ImageStar(star2.centroid, star2.brightness, star2.perimeter, star2.area)
-                star_y = ImageStar(star3.centroid, star3.brightness, star3.perimeter, star3.area)
-                star_both = ImageStar(star1.centroid, star1.brightness, star1.perimeter, star1.area)
-                star_x.set_real_star(self.get_star_by_id(hip_x))
-                star_y.set_real_star(self.get_star_by_id(hip_y))
-                star_both.set_real_star(self.get_star_by_id(hip_both))
-                other_distance = star_x.real_star.get_distance(star_y.real_star)
-                # Distance BC-threshold < others_distance < BC+threshold
-                if d_star2_star3-err3 < other_distance < d_star2_star3+err3:
-                    triplets.append([star_x, star_y, star_both])
+        # distance BC star2_star3.
+        # The pairs are joined by the star present in both of them, two
+        # different pairs can only share one star.
+        joins = []
+        for col_ab, col_ac in [(0, 0), (0, 1), (1, 0), (1, 1)]:
+            i, j = self._join_hips(pairs_a_b[:, col_ab], pairs_a_c[:, col_ac])
+            joins.append((i, j, pairs_a_b[i, col_ab], pairs_a_b[i, 1 - col_ab],
+                          pairs_a_c[j, 1 - col_ac]))
+        i, j, hip_both, hip_x, hip_y = [np.concatenate(cols) for cols in zip(*joins)]
+
+        # The same pair in AB and AC gives the same star as x and y, its
+        # distance would be 0, out of range
+        different = hip_x != hip_y
+        other_distance = self.get_distances(hip_x[different], hip_y[different])
+        # Distance BC-threshold < others_distance < BC+threshold
+        in_range = np.zeros(len(hip_x), dtype=bool)
+        in_range[different] = (d_star2_star3-err3 < other_distance) & \
+            (other_distance < d_star2_star3+err3)
+
+        # Keep the order of the pairs AB, AC in the catalog
+        survivors = np.nonzero(in_range)[0]
+        survivors = survivors[np.lexsort((j[survivors], i[survivors]))]
+        for k in survivors:
+            star_x = ImageStar(star2.centroid, star2.brightness, star2.perimeter, star2.area)
+            star_y = ImageStar(star3.centroid, star3.brightness, star3.perimeter, star3.area)
+            star_both = ImageStar(star1.centroid, star1.brightness, star1.perimeter, star1.area)
+            star_x.set_real_star(self.get_star_by_id(hip_x[k]))
+            star_y.set_real_star(self.get_star_by_id(hip_y[k]))
+            star_both.set_real_star(self.get_star_by_id(hip_both[k]))
+            triplets.append([star_x, star_y, star_both])
 
         return triplets
 
+    def _get_pairs_hips(self, a, b):
+        """Returns the HIP numbers of the pairs for which their angular
+        distance is greater than a and lower than b.
+
+        :return: (n, 2) int64 array"""
+        start, end = self._get_pairs_range(a, b)
+
+        return self._guide_stars_catalog[start:end, :-1].astype(np.int64)
+
+    @classmethod
+    def _join_hips(cls, hips_a, hips_b):
+        """Returns the indices (i, j) of all the combinations for which
+        hips_a[i] == hips_b[j], sorted by i."""
+        order = np.argsort(hips_b, kind='stable')
+        sorted_b = hips_b[order]
+        left = np.searchsorted(sorted_b, hips_a, side='left')
+        counts = np.searchsorted(sorted_b, hips_a, side='right') - left
+        i = np.repeat(np.arange(len(hips_a)), counts)
+        offsets = np.arange(len(i)) - np.repeat(np.cumsum(counts) - counts, counts)
+        j = order[np.repeat(left, counts) + offsets]
+
+        return i, j
+
+    def get_unit_vectors(self, hip_numbers):
+        """Returns the cartesian coordinates of the given stars.
+
+        :param hip_numbers: List or array of HIP numbers.
+        :return: (N, 3) array
+        :raises KeyError: If a star is not in the catalog."""
+        rows = self._get_rows(hip_numbers)
+        if np.any(rows < 0):
+            missing = np.asarray(hip_numbers, dtype=np.int64)[rows < 0]
+            raise KeyError(f"Stars not in the catalog: {missing.tolist()}")
+
+        return self._unit_vectors[rows]
+
+    def get_distances(self, hips_a, hips_b):
+        """Returns the angular distances between the stars hips_a[i] and
+        hips_b[i].
+
+        :param hips_a: List or array of HIP numbers.
+        :param hips_b: List or array of HIP numbers, same length as hips_a.
+        :return: Array of angular distances in degrees.
+        :raises KeyError: If a star is not in the catalog."""
+        v_a = self.get_unit_vectors(hips_a)
+        v_b = self.get_unit_vectors(hips_b)
+        dot = v_a[:, 0] * v_b[:, 0] + v_a[:, 1] * v_b[:, 1] + v_a[:, 2] * v_b[:, 2]
+
+        # Rounding can take the dot product of close stars slightly over 1
+        return np.degrees(np.arccos(np.clip(dot, -1, 1)))
+
     def _get_triplets(self, img_stars, err=0.005):
         """
         threshold: degrees to extend the angular distance to"""
@@ -253,32 +506,20 @@ class Catalog:
                 if (triplet_i[0] in triplet_j and triplet_i[1] in triplet_j):
                     new_i = int(triplet_i[2].real_star.hip_number)
                     new_j = int(self._get_not_matched(triplet_j, [triplet_i[0], triplet_i[1]]).real_star.hip_number)
-                    distance_index = np.where(((self._guide_stars_catalog[:,1] == new_i) &
-                                               (self._guide_stars_catalog[:,0] == new_j)) |
-                                              ((self._guide_stars_catalog[:,1] == new_j) &
-                                               (self._guide_stars_catalog[:,0] == new_i)))
-                    if len(distance_index[0]) > 0:
-                        distance = self._guide_stars_catalog[distance_index[0][0]][2]
+                    distance = self.get_pair_distance(new_i, new_j)
+                    if distance is not None:
                         common.append(triplet_i + [star for star in triplet_j if star not in triplet_i])
                 elif (triplet_i[0] in triplet_j and triplet_i[2] in triplet_j):
                     new_i = int(triplet_i[1].real_star.hip_number)
                     new_j = int(self._get_not_matched(triplet_j, [triplet_i[0], triplet_i[2]]).real_star.hip_number)
-                    distance_index = np.where(((self._guide_stars_catalog[:,1] == new_i) &
-                                               (self._guide_stars_catalog[:,0] == new_j)) |
-                                              ((self._guide_stars_catalog[:,1] == new_j) &
-                                               (self._guide_stars_catalog[:,0] == new_i)))
-                    if len(distance_index[0]) > 0:
-                        distance = self._guide_stars_catalog[distance_index[0][0]][2]
+                    distance = self.get_pair_distance(new_i, new_j)
+                    if distance is not None:
                         common.append(triplet_i + [star for star in triplet_j if star not in triplet_i])
                 elif (triplet_i[1] in triplet_j and triplet_i[2] in triplet_j):
                     new_i = int(triplet_i[0].real_star.hip_number)
                     new_j = int(self._get_not_matched(triplet_j, [triplet_i[1], triplet_i[2]]).real_star.hip_number)
-                    distance_index = np.where(((self._guide_stars_catalog[:,1] == new_i) &
-                                               (self._guide_stars_catalog[:,0] == new_j)) |
-                                              ((self._guide_stars_catalog[:,1] == new_j) &
-                                               (self._guide_stars_catalog[:,0] == new_i)))
-                    if len(distance_index[0]) > 0:
-                        distance = self._guide_stars_catalog[distance_index[0][0]][2]
+                    distance = self.get_pair_distance(new_i, new_j)
+                    if distance is not None:
                         common.append(triplet_i + [star for star in triplet_j if star not in triplet_i])
         return common
 
@@ -347,12 +588,20 @@ class Catalog:
                     star.set_real_star(self.get_star_by_id(found_id.real_star.hip_number))
                     star.set_identified(True)
 
-    def find_stars_pattern(self, stars, err):
-        """4 stars are needed"""
+    def find_stars_pattern(self, stars, err, stats=None):
+        """4 stars are needed
+
+        :param stats: Optional dictionary, filled with the number of
+        'iterations' run and the final error 'c_err'."""
         pattern = []
         star1, star2, star3, star4 = stars
         c_err = 0.003
+        iterations = 0
         while c_err < err:
+            iterations += 1
+            if stats is not None:
+                stats['iterations'] = iterations
+                stats['c_err'] = c_err
             # Get triplets in abc
             triplets1 = self._get_triplets([star1, star2, star3], err=c_err)
             # Get triplets in abd
@@ -1,8 +1,9 @@
 #!/usr/bin/env python
 import argparse
 import csv
+from collections import deque
+from multiprocessing import Pool, cpu_count
 from novas import compat as novas
-from utils import CatEntry
 
 
 def data_complete(star):
@@ -61,67 +62,136 @@ def deg_min_sec_to_dec_deg(deg_min_sec):
         return -dec_deg
     return dec_deg
 
-def main(args):
-    date = args.date.split(' ')
+def read_stars(input_path):
+    """Lazily read the Hipparcos dump, yielding the fields needed to
+    propagate every star with complete data"""
+    with open(input_path, 'r') as raw:
+        for line in raw:
+            fields = [field.strip() for field in line.split('|')]
+            if not data_complete(fields):
+                continue
+            parallax = float(fields[11]) if float(fields[11]) > 0 else 0.0
+            yield (fields[1], int(fields[1]), deg_to_decimal_time(float(fields[8])),
+                   float(fields[9]), float(fields[12]), float(fields[13]),
+                   parallax, float(fields[5]))
+
+
+def chunks(iterable, size):
+    """Split an iterable into lists of `size` elements"""
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def julian_date_tt(date):
+    """Terrestrial Time julian date of a date: "2020 8 21 12.5" """
+    date = date.split(' ')
     leap_secs = 37
-    epoc_hip = 2448349.0625
-    # Date to convert the catalog to
     jd_utc = novas.julian_date(int(date[0]), int(date[1]),
                                int(date[2]), float(date[3]))
-    jd_tt = jd_utc + (leap_secs + 32.184) / 86400
-    # jd_tt = novas.julian_date(1991, 4, 2, 12.5)
-    converted = []
-
-    # Read the original catalog content
-    with open(args.input, 'r') as raw:
-        content = [
-            [field.strip() for field in line.split('|')]
-            for line in raw
-        ]
-
-    for line in content:
-        if not data_complete(line):
-            continue
-        ra_hours = deg_to_decimal_time(float(line[8]))
-        parallax = float(line[11]) if float(line[11]) > 0 else 0.0
-        vmag = float(line[5])
-        star = novas.make_cat_entry(line[1], "HIP", int(line[1]),
-                                    float(ra_hours), float(line[9]),
-                                    float(line[12]), float(line[13]),
-                                    parallax, 0.0)
-
-        star_con = novas.transform_cat(1, epoc_hip, star, jd_tt, "HP2")
-        star_entry = CatEntry(star_con.starname, star_con.catalog,
-                              star_con.starnumber, star_con.ra,
-                              star_con.dec, star_con.promora,
-                              star_con.promodec, star_con.parallax,
-                              star_con.radialvelocity, vmag)
-        converted.append(star_entry)
-
-    # Write new catalog into a file
-    with open(args.output, mode='w') as csv_file:
-        fieldnames = ['HIP_number', 'ra_degrees', 'dec_degrees',
-                      'promora', 'promodec', 'parallax', 'vmag']
-        writer = csv.DictWriter(csv_file, fieldnames=fieldnames)
-        writer.writeheader()
-        for star in converted:
-            writer.writerow({
-                'HIP_number': star.starnumber,
-                'ra_degrees': "{0:.8f}".format(decimal_time_to_degrees(star.ra)),
-                'dec_degrees': "{0:.8f}".format(star.dec),
-                'promora': "{0:.8f}".format(star.promora),
-                'promodec': "{0:.8f}".format(star.promodec),
-                'parallax': "{0:.8f}".format(star.parallax),
-                'vmag': "{0:.2f}".format(star.vmag),
+
+    return jd_utc + (leap_secs + 32.184) / 86400
+
+
+def propagate_chunk(job):
+    """Propagate a chunk of stars to several epochs.
+
+    :param job: (stars, [jd_tt, ...])
+    :return: List with the rows of the chunk for every epoch"""
+    stars, epochs = job
+    epoc_hip = 2448349.0625
+    rows = [[] for _ in epochs]
+    for starname, starnumber, ra_hours, dec, promora, promodec, parallax, vmag in stars:
+        star = novas.make_cat_entry(starname, "HIP", starnumber, ra_hours, dec,
+                                    promora, promodec, parallax, 0.0)
+        for i, jd_tt in enumerate(epochs):
+            star_con = novas.transform_cat(1, epoc_hip, star, jd_tt, "HP2")
+            rows[i].append({
+                'HIP_number': star_con.starnumber,
+                'ra_degrees': "{0:.8f}".format(decimal_time_to_degrees(star_con.ra)),
+                'dec_degrees': "{0:.8f}".format(star_con.dec),
+                'promora': "{0:.8f}".format(star_con.promora),
+                'promodec': "{0:.8f}".format(star_con.promodec),
+                'parallax': "{0:.8f}".format(star_con.parallax),
+                'vmag': "{0:.2f}".format(vmag),
             })
 
+    return rows
+
+
+def write_rows(writers, rows):
+    """Write the rows of a propagated chunk, the rows of every epoch with
+    its writer"""
+    for writer, epoch_rows in zip(writers, rows):
+        writer.writerows(epoch_rows)
+
+
+def output_paths(output, dates):
+    """Output path for every date, {year}, {month} and {day} in the output
+    are replaced by the date values"""
+    paths = []
+    for date in dates:
+        year, month, day = date.split(' ')[:3]
+        paths.append(output.format(year=year, month=month, day=day))
+
+    return paths
+
+
+def main(args):
+    # Dates to convert the catalog to
+    epochs = [julian_date_tt(date) for date in args.dates]
+    paths = output_paths(args.output, args.dates)
+    if len(set(paths)) != len(paths):
+        raise ValueError("Use {year}, {month} or {day} in the output path "
+                         "to write several dates")
+
+    fieldnames = ['HIP_number', 'ra_degrees', 'dec_degrees',
+                  'promora', 'promodec', 'parallax', 'vmag']
+    csv_files = [open(path, mode='w') for path in paths]
+    writers = [csv.DictWriter(csv_file, fieldnames=fieldnames)
+               for csv_file in csv_files]
+    for writer in writers:
+        writer.writeheader()
+
+    # Propagate the chunks in a pool of processes, writing them in order
+    # as soon as they are done. Pool.imap would read the whole input ahead
+    # of the workers, so only a window of chunks is submitted at once
+    processes = args.processes or cpu_count()
+    window = 2 * processes
+    pending = deque()
+    try:
+        with Pool(processes=processes) as pool:
+            for stars in chunks(read_stars(args.input), args.chunk_size):
+                pending.append(pool.apply_async(propagate_chunk, ((stars, epochs),)))
+                if len(pending) >= window:
+                    write_rows(writers, pending.popleft().get())
+            while pending:
+                write_rows(writers, pending.popleft().get())
+    finally:
+        for csv_file in csv_files:
+            csv_file.close()
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument('-i', '--input', required=True, dest='input',
                         help='Hipparcos input dat path')
     parser.add_argument('-o', '--output', required=True, dest='output',
-                        help='Output CSV converted path')
-    parser.add_argument('-d', '--date', required=True, dest='date',
-                        help='Date to convert to: "2020 8 21 12.5"')
+                        help='Output CSV converted path, it may contain '
+                        '{year}, {month} and {day}: "hip_{year}.csv"')
+    parser.add_argument('-d', '--date', required=True, dest='dates',
+                        action='append',
+                        help='Date to convert to: "2020 8 21 12.5", '
+                        'it can be given several times')
+    parser.add_argument('-p', '--processes', dest='processes', type=int,
+                        default=None,
+                        help='Number of processes, defaults to the CPU count')
+    parser.add_argument('-c', '--chunk-size', dest='chunk_size', type=int,
+                        default=2000, help='Stars propagated by each job')
 
     main(parser.parse_args())
@@ -1,60 +1,90 @@
 #!/usr/bin/env python3
 import argparse
 import csv
+from os.path import splitext
+import numpy as np
 
 
-def generate_k_vector(guide_catalog):
-    k_vector = []
-    z = []
-    n = len(guide_catalog)
-    m = (guide_catalog[-1][2]-guide_catalog[0][2])/(n-1)
-    q = guide_catalog[0][2]-m
+def generate_k_vector(distances):
+    """Generate the k-vector of a sorted column of distances.
 
-    k_vector.append(0)
-    for i in range(0, n):
-        z.append(i*m+q)
+    k_vector[j] is the number of distances lower than the line z(j) = m*j + q,
+    so the distances in a range [a, b] are found between
+    k_vector[(a - q) / m] and k_vector[(b - q) / m + 1].
 
-    for j in range(1, n-1):
-        number = len([i for i in guide_catalog if i[2] < z[j]])
-        k_vector.append(number)
+    :param distances: Sorted distances of the guide catalog pairs.
+    :return: (k_vector, m, q)
+    :raises ValueError: If there are less than two different distances, the
+    line can not be fitted."""
+    distances = np.asarray(distances, dtype=np.float64)
+    n = len(distances)
+    if n < 2:
+        raise ValueError(f"The k-vector needs at least two distances, got {n}")
+    if distances[-1] <= distances[0]:
+        raise ValueError("The k-vector needs sorted distances which are not all "
+                         f"equal, got {distances[0]} to {distances[-1]}")
+    m = (distances[-1] - distances[0]) / (n - 1)
+    q = distances[0] - m
 
-    k_vector.append(n)
+    # All the bins are counted in a single binary search pass
+    z = np.arange(n) * m + q
+    k_vector = np.searchsorted(distances, z, side='left').astype(np.int32)
+    k_vector[0] = 0
+    k_vector[-1] = n
 
-    return k_vector
+    return k_vector, m, q
 
 
 def read_catalog(catalog_csv):
+    """Read the guide catalog sorted by distance.
+
+    :return: numpy array of [HIP_number_a, HIP_number_b, distance]"""
     catalog = []
     with open(catalog_csv, 'r') as csv_file:
         csv_reader = csv.DictReader(csv_file)
-        line_count = 0
         for row in csv_reader:
-            if line_count != 0:
-                catalog.append([int(row['HIP_number_a']),
-                                int(row['HIP_number_b']),
-                                float(row['distance'])
-                                ])
-            line_count += 1
+            catalog.append([int(row['HIP_number_a']),
+                            int(row['HIP_number_b']),
+                            float(row['distance'])
+                            ])
+    catalog = np.array(catalog)
+
+    return catalog[np.argsort(catalog[:, 2], kind='stable')]
+
+
+def k_vector_path(catalog_csv):
+    """Default path of the k-vector, next to the guide catalog CSV."""
+    return splitext(catalog_csv)[0] + "_k_vector.npz"
+
+
+def write_k_vector(catalog_csv, output=None):
+    """Build the k-vector of a guide catalog CSV and save it with its line
+    coefficients in a binary npz file.
+
+    :param catalog_csv: Guide catalog CSV path.
+    :param output: Output path, defaults to the catalog path with the
+    '_k_vector.npz' suffix.
+    :return: Output path."""
+    if output is None:
+        output = k_vector_path(catalog_csv)
+    catalog = read_catalog(catalog_csv)
+    k_vector, m, q = generate_k_vector(catalog[:, 2])
+    np.savez(output, k_vector=k_vector, m=m, q=q)
 
-    return catalog
+    return output
 
 
 def main(args):
-    catalog = read_catalog(args.input)
-    k_vector = generate_k_vector(catalog)
-    with open(args.output, mode='w') as csv_file:
-        fieldnames = ['stars_count']
-        writer = csv.DictWriter(csv_file, fieldnames=fieldnames)
-        writer.writeheader()
-        for total_stars in k_vector:
-            writer.writerow({'stars_count': total_stars})
+    output = write_k_vector(args.input, args.output)
+    print(f"k-vector written to {output}")
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument('-i', '--input', required=True, dest='input',
                         help='Sorted guide catalog input CSV path')
-    parser.add_argument('-o', '--output', required=True, dest='output',
-                        help='Output k-vector csv')
+    parser.add_argument('-o', '--output', dest='output', default=None,
+                        help='Output k-vector npz, defaults to '
+                        '<input>_k_vector.npz')
 
     main(parser.parse_args())
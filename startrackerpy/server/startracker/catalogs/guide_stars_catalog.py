@@ -1,37 +1,64 @@
 #!/usr/bin/env python3
 import math
 import argparse
-import itertools
 import csv
 import time
 import numpy as np
+from scipy.spatial import cKDTree
 from astropy import units as u
 from astropy.coordinates import SkyCoord
-from astroquery.simbad import Simbad
-from os.path import splitext
+from os.path import splitext, exists
 from utils import CatEntry, convertRADEC
+from generate_k_vector import write_k_vector
 
 
 
+def query_pairs(tree, r):
+    """Pairs of points of a cKDTree closer than r, as an (N, 2) array.
+
+    The set returned by the scipy versions without the output_type
+    argument is converted to the same array."""
+    try:
+        return tree.query_pairs(r, output_type='ndarray')
+    except TypeError:
+        pairs = np.array(sorted(tree.query_pairs(r)), dtype=np.intp)
+        return pairs.reshape(-1, 2)
+
+
 def generate_guide_catalog(catalog):
     """Generate a catalog with the angular distance of all stars
-    combinations"""
-    guide_catalog = []
+    combinations closer than the FOV diagonal, sorted by distance.
+
+    The stars are indexed in a KD-tree by their unit vectors, so only the
+    pairs within the chord length of the FOV are checked."""
     FOV_h = 2 * 14.455
     FOV_v = 2 * 10.94
     FOV = math.sqrt(FOV_h**2 + FOV_v**2)
 
-    for a, b in itertools.combinations(catalog, 2):
-        a_car = convertRADEC(a.ra, a.dec + 90)
-        b_car = convertRADEC(b.ra, b.dec + 90)
-        dab = math.degrees(math.acos(a_car[0] * b_car[0] +
-                                     a_car[1] * b_car[1] +
-                                     a_car[2] * b_car[2]))
-
-        if dab < FOV:
-            guide_catalog.append([a.starnumber, b.starnumber, dab])
+    hip_numbers = np.array([star.starnumber for star in catalog])
+    vectors = np.array([convertRADEC(star.ra, star.dec + 90)
+                        for star in catalog])
+    # Chord length between two unit vectors separated by the FOV, slightly
+    # wider to keep the pairs in the limit, they are filtered below
+    chord = 2 * math.sin(math.radians(FOV) / 2) * (1 + 1e-9)
+    tree = cKDTree(vectors)
+    pairs = query_pairs(tree, chord)
+    pairs = pairs[np.lexsort((pairs[:, 1], pairs[:, 0]))]
+    a_car = vectors[pairs[:, 0]]
+    b_car = vectors[pairs[:, 1]]
+    dab = np.degrees(np.arccos(np.clip(a_car[:, 0] * b_car[:, 0] +
+                                       a_car[:, 1] * b_car[:, 1] +
+                                       a_car[:, 2] * b_car[:, 2], -1, 1)))
+    in_fov = dab < FOV
+    pairs = pairs[in_fov]
+    dab = dab[in_fov]
+
+    # Sort by distance, keeping the combinations order for the same distance
+    order = np.argsort(dab, kind='stable')
+    guide_catalog = [[int(a), int(b), float(distance)] for a, b, distance in
+                     zip(hip_numbers[pairs[order, 0]],
+                         hip_numbers[pairs[order, 1]], dab[order])]
 
-    guide_catalog.sort(key=lambda x: x[2])
     return guide_catalog
 
 
@@ -55,61 +82,125 @@ def read_catalog(catalog_csv, Vmag):
             line_count += 1
     return catalog
 
-def label_guide_stars(filename, catalog, guide_stars):
-    stars = np.array(guide_stars)
-    # Get unique guide_stars
-    unique = np.unique(stars[:,:-1])
-    hip_names = []
-    checked = 0
-    labeled = 0
-    # Need a tuple of [HIP_number, ra, dec] for all guide stars
-    for hip_star in catalog:
-        # Stop earlier if all guide stars are already labeled.
-        if checked == len(unique):
+def simbad_resolver(hip_star):
+    """Query Simbad for the object of a star, then its name. The HIP number
+    is used when the object has no name, and an empty name when there is
+    no object."""
+    # Imported here, the rebuilds from the names cache do not need it
+    from astroquery.simbad import Simbad
+    c = SkyCoord(ra=hip_star.ra, dec=hip_star.dec, unit=u.deg)
+    print(c)
+    while True:
+        try:
+            reg = Simbad.query_region(c, radius=0.01*u.deg)
+        except:
+            time.sleep(5)
+            continue
+        break
+    name = ""
+    if len(reg[0]) > 0:
+        while True:
+            try:
+                objs = Simbad.query_objectids(reg[0][0])
+            except:
+                time.sleep(5)
+                continue
             break
-        if hip_star.starnumber in unique:
-            # Query Simbad for its object, then name
-            c = SkyCoord(ra=hip_star.ra, dec=hip_star.dec, unit=u.deg)
-            print(c)
-            while True:
-                try:
-                    reg = Simbad.query_region(c, radius=0.01*u.deg)
-                except:
-                    time.sleep(5)
-                    continue
-                break
-            name = ""
-            if len(reg[0]) > 0:
-                while True:
-                    try:
-                        objs = Simbad.query_objectids(reg[0][0])
-                    except:
-                        time.sleep(5)
-                        continue
+        if len(objs) > 0:
+            name = str(hip_star.starnumber)
+            for obj in objs:
+                if "NAME" in obj[0]:
+                    name = obj[0].replace("NAME", "").strip().lower()
+                    print(name)
                     break
-                if len(objs) > 0:
-                    noname = True
-                    for name in objs:
-                        if "NAME" in name[0]:
-                            name = name[0].replace("NAME", "").strip().lower()
-                            noname = False
-                            labeled += 1
-                            print(name)
-                            break
-                    if noname:
-                        name = str(hip_star.starnumber)
-
-            time.sleep(0.2)
-            hip_names.append([hip_star.starnumber, name])
-            checked += 1
-            print(f'{checked=} {labeled=}')
+
+    time.sleep(0.2)
+    return name
+
+
+def stub_resolver(hip_star):
+    """Offline resolver, names every star by its HIP number"""
+    return str(hip_star.starnumber)
+
+
+def read_names_cache(cache_csv):
+    """Read the names cache, a dictionary of HIP number to name"""
+    names = {}
+    if cache_csv is None or not exists(cache_csv):
+        return names
+    with open(cache_csv, 'r') as csv_file:
+        csv_reader = csv.DictReader(csv_file)
+        for row in csv_reader:
+            names[int(row['HIP_number'])] = row['Name']
+
+    return names
+
+
+def resolve_names(stars, names, resolver, cache_csv=None):
+    """Resolve the names of the stars which are not in the names dictionary
+    yet. The new names are appended to the cache file as soon as they are
+    resolved, so an interrupted rebuild does not query them again.
+
+    :param stars: List of CatEntry to name.
+    :param names: Dictionary of HIP number to name, updated in place.
+    :param resolver: Function returning the name of a CatEntry.
+    :param cache_csv: Names cache CSV path, None to not persist them.
+    :return: Number of stars resolved by the resolver."""
+    misses = [star for star in stars if int(star.starnumber) not in names]
+    if not misses:
+        return 0
+
+    cache_file = None
+    if cache_csv is not None:
+        new_cache = not exists(cache_csv)
+        cache_file = open(cache_csv, mode='a')
+        writer = csv.DictWriter(cache_file, fieldnames=['HIP_number', 'Name'])
+        if new_cache:
+            writer.writeheader()
+    try:
+        for star in misses:
+            name = resolver(star)
+            names[int(star.starnumber)] = name
+            if cache_file is not None:
+                writer.writerow({'HIP_number': star.starnumber, 'Name': name})
+                cache_file.flush()
+    finally:
+        if cache_file is not None:
+            cache_file.close()
+
+    return len(misses)
+
+
+def label_guide_stars(filename, catalog, guide_stars, cache_csv=None,
+                      resolver=simbad_resolver, update_cache=True):
+    """Write a file with the name of every guide star.
+
+    :param filename: Output labels CSV path.
+    :param catalog: List of CatEntry.
+    :param guide_stars: Guide stars pairs.
+    :param cache_csv: Names cache CSV path, only the guide stars missing
+    in it are resolved.
+    :param resolver: Function returning the name of a CatEntry.
+    :param update_cache: Append the resolved names to the cache."""
+    stars = np.array(guide_stars)
+    # Get unique guide_stars
+    unique = set(np.unique(stars[:, :-1]).astype(int).tolist())
+    guide_catalog = [hip_star for hip_star in catalog
+                     if int(hip_star.starnumber) in unique]
+
+    names = read_names_cache(cache_csv)
+    resolved = resolve_names(guide_catalog, names, resolver,
+                             cache_csv if update_cache else None)
+    print(f'{len(guide_catalog)} guide stars, {resolved} resolved, '
+          f'{len(guide_catalog) - resolved} from the cache')
 
     with open(filename, mode='w') as csv_file:
         fieldnames = ['HIP_number', 'Name']
         writer = csv.DictWriter(csv_file, fieldnames=fieldnames)
         writer.writeheader()
-        for star in hip_names:
-            writer.writerow({'HIP_number': star[0], 'Name': star[1]})
+        for star in guide_catalog:
+            writer.writerow({'HIP_number': star.starnumber,
+                             'Name': names[int(star.starnumber)]})
 
 
 def main(args):
@@ -128,9 +219,14 @@ def main(args):
                 'HIP_number_b': row[1],
                 'distance': row[2]
             })
+    # Rebuild the k-vector index of the new catalog
+    write_k_vector(args.output)
     # Write a file with labels for each guide star
     labels_filename = split_name[0] + "_labels" + split_name[1]
-    label_guide_stars(labels_filename, catalog, guide_stars)
+    resolver = stub_resolver if args.offline else simbad_resolver
+    label_guide_stars(labels_filename, catalog, guide_stars,
+                      cache_csv=args.names_cache, resolver=resolver,
+                      update_cache=not args.offline)
 
 
 if __name__ == "__main__":
@@ -141,5 +237,12 @@ if __name__ == "__main__":
                         help='Output CSV converted path')
     parser.add_argument('-m', '--magnitude', required=True, dest='v_mag',
                         help='Vmag cutoff')
+    parser.add_argument('-n', '--names-cache', dest='names_cache',
+                        default='./out/names_cache.csv',
+                        help='Names cache CSV path, only the stars missing '
+                        'in it are queried. A labels CSV can be used as cache')
+    parser.add_argument('--offline', dest='offline', action='store_true',
+                        help='Do not query Simbad, the stars missing in the '
+                        'names cache are named by their HIP number')
 
     main(parser.parse_args())
@@ -1,10 +1,9 @@
 #!/usr/bin/env python3
 import imutils
 from io import BytesIO
-from scipy.stats import norm
 import cv2
 import numpy as np
-from server import catalog
+import server
 from server.startracker.image_star import ImageStar, Centroid
 import matplotlib.pyplot as plt
 from astropy import units as u
@@ -19,24 +18,149 @@ class ImageUtils:
         pass
 
     @classmethod
-    def get_threshold(cls, img, thresh_max=170):
-        """Get the threshold value analyzing the normal distribution of
-        the image's histogram
+    def get_histogram(cls, img):
+        """Calculate the 256 bins histogram of a grayscale image.
+
+        :param img: Image to calculate the histogram to.
+        :return: Histogram as a (256, 1) float32 array."""
+        return cv2.calcHist([img], [0], None, [256], [0, 256])
+
+    @classmethod
+    def get_threshold(cls, img, thresh_max=170, method="normal", hist=None):
+        """Get the threshold value analyzing the histogram of the image
 
         :param img: Image to analyze
         :param thresh_max: Maximum value for threshold as limit
+        :param method: 'normal' uses the mean and std of the histogram,
+        'sigma_clip' the mean and std of the background after clipping the
+        bright pixels, 'otsu' and 'triangle' the algorithms of the same name.
+        :param hist: Histogram of the image, calculated if not given.
         """
-        mean, std = norm.fit(img)
-        threshold = int(mean + 3.6 * std)
+        if hist is None:
+            hist = cls.get_histogram(img)
+        hist = np.asarray(hist, dtype=np.float64).ravel()
+
+        if method == "sigma_clip":
+            threshold = cls._get_threshold_sigma_clip(hist)
+        elif method == "otsu":
+            threshold = cls._get_threshold_otsu(hist)
+        elif method == "triangle":
+            threshold = cls._get_threshold_triangle(hist)
+        else:
+            mean, std = cls._get_histogram_stats(hist)
+            threshold = int(mean + 3.6 * std)
+
         if thresh_max:
             threshold = threshold if threshold < thresh_max else thresh_max
 
         return threshold
 
     @classmethod
-    def get_image_stars(cls, img, gray):
+    def _get_histogram_stats(cls, hist, low=0, high=255):
+        """Mean and standard deviation of the pixels between two levels.
+
+        :param hist: Flat histogram of the image.
+        :param low: First level to take into account.
+        :param high: Last level to take into account.
+        :return: (mean, std)"""
+        levels = np.arange(low, high + 1)
+        counts = hist[low:high + 1]
+        total = counts.sum()
+        if total == 0:
+            return 0, 0
+        mean = (counts * levels).sum() / total
+        std = np.sqrt((counts * (levels - mean) ** 2).sum() / total)
+
+        return mean, std
+
+    @classmethod
+    def _get_threshold_sigma_clip(cls, hist, sigma=3, iterations=10):
+        """Threshold over the background, estimated by iteratively
+        discarding the levels further than sigma deviations from the mean.
+
+        :param hist: Flat histogram of the image.
+        :param sigma: Number of deviations kept at each iteration.
+        :param iterations: Maximum number of iterations."""
+        low, high = 0, 255
+        mean, std = cls._get_histogram_stats(hist, low, high)
+        for _ in range(iterations):
+            new_low = max(0, int(np.floor(mean - sigma * std)))
+            new_high = min(255, int(np.ceil(mean + sigma * std)))
+            if (new_low, new_high) == (low, high):
+                break
+            low, high = new_low, new_high
+            mean, std = cls._get_histogram_stats(hist, low, high)
+
+        return int(mean + 3.6 * std)
+
+    @classmethod
+    def _get_threshold_otsu(cls, hist):
+        """Otsu's threshold, the level which maximizes the variance between
+        the background and foreground classes.
+
+        :param hist: Flat histogram of the image."""
+        levels = np.arange(len(hist))
+        weights = np.cumsum(hist)
+        means = np.cumsum(hist * levels)
+        total = weights[-1]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            variance = (means[-1] * weights - means * total) ** 2 / \
+                (weights * (total - weights))
+        variance[~np.isfinite(variance)] = 0
+
+        return int(np.argmax(variance))
+
+    @classmethod
+    def _get_threshold_triangle(cls, hist):
+        """Triangle threshold, the level furthest from the line between the
+        histogram peak and the end of its longest tail.
+
+        :param hist: Flat histogram of the image."""
+        nonzero = np.nonzero(hist)[0]
+        if len(nonzero) == 0:
+            return 0
+        first, last = nonzero[0], nonzero[-1]
+        peak = int(np.argmax(hist))
+        # Star images have a dark background, so the tail is usually at
+        # the right of the peak, the left one is mirrored otherwise
+        if last - peak >= peak - first:
+            levels = np.arange(peak, last + 1)
+            end = last
+        else:
+            levels = np.arange(first, peak + 1)
+            end = first
+        if end == peak:
+            return peak
+        # Height of the line over the histogram, proportional to the distance
+        line = hist[peak] * (end - levels) / (end - peak)
+        distances = line - hist[levels]
+
+        return int(levels[np.argmax(distances)])
+
+    @classmethod
+    def get_image_stars(cls, img, gray, method="contours", subpixel=False):
         """Return the ImageStar objects found in a thresholded image
 
+        :param img: thresholded image to analyze
+        :param gray: grayscale version of the original image
+        :param method: 'contours' to analyze every contour or 'components'
+        to label all the blobs in a single pass.
+        :param subpixel: Refine the centroids with sub-pixel precision."""
+        if method == "components":
+            # Its intensity-weighted centroids are already sub-pixel
+            img_stars = cls._get_image_stars_components(img, gray, subpixel)
+        else:
+            img_stars = cls._get_image_stars_contours(img, gray)
+            if subpixel:
+                cls.refine_centroids(img_stars, gray)
+
+        return img_stars
+
+    @classmethod
+    def _get_image_stars_contours(cls, img, gray):
+        """Return the ImageStar objects found in a thresholded image,
+        analyzing each one of its contours.
+
         :param img: thresholded image to analyze
         :param gray: grayscale version of the original image"""
 
@@ -83,6 +207,109 @@ class ImageUtils:
         img_stars = sorted(img_stars, key=lambda x: x.brightness, reverse=True)
         return img_stars
 
+    @classmethod
+    def _get_image_stars_components(cls, img, gray, subpixel=False):
+        """Return the ImageStar objects found in a thresholded image, using
+        its connected components. The intensity-weighted centroid and mean
+        brightness of all the blobs are computed at once with labelled sums
+        over their pixels. The area and perimeter are the ones of the blob
+        contour, as in the contours method, which is only traced for the
+        blobs of at least 3 pixels.
+
+        :param img: thresholded image to analyze
+        :param gray: grayscale version of the original image
+        :param subpixel: Keep the float centroids instead of truncating them
+        to pixels."""
+        count, labels, stats, _ = cv2.connectedComponentsWithStats(img, connectivity=8)
+
+        # Only the pixels of the blobs, label 0 is the background
+        pixels = np.flatnonzero(labels)
+        pixel_labels = labels.ravel()[pixels]
+        intensity = gray.ravel()[pixels].astype(np.float64)
+        pixels_y, pixels_x = np.divmod(pixels, labels.shape[1])
+
+        # Sums for every label
+        sum_intensity = np.bincount(pixel_labels, weights=intensity, minlength=count)
+        sum_x = np.bincount(pixel_labels, weights=intensity * pixels_x, minlength=count)
+        sum_y = np.bincount(pixel_labels, weights=intensity * pixels_y, minlength=count)
+        pixel_count = stats[:, cv2.CC_STAT_AREA]
+
+        img_stars = []
+        # The contour area of a blob is lower than its number of pixels, so
+        # the blobs of lesser than 3 pixels are discarded below
+        for label in np.nonzero(pixel_count[1:] >= 3)[0] + 1:
+            left = stats[label, cv2.CC_STAT_LEFT]
+            top = stats[label, cv2.CC_STAT_TOP]
+            width = stats[label, cv2.CC_STAT_WIDTH]
+            height = stats[label, cv2.CC_STAT_HEIGHT]
+            # Contour of the blob, traced in its bounding box
+            blob = np.uint8(labels[top:top+height, left:left+width] == label)
+            cnts = cv2.findContours(blob, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE,
+                                    offset=(int(left), int(top)))
+            contour = max(imutils.grab_contours(cnts), key=len)
+
+            # Discard stars with area lesser than 3, as the contours method
+            area = cv2.moments(contour)["m00"]
+            if area < 3:
+                continue
+            perimeter = cv2.arcLength(contour, True)
+
+            # Blobs of zero intensity are centered in their bounding box
+            if sum_intensity[label] > 0:
+                x = sum_x[label] / sum_intensity[label]
+                y = sum_y[label] / sum_intensity[label]
+            else:
+                x = left + width / 2
+                y = top + height / 2
+            centroid = Centroid(float(x), float(y)) if subpixel else Centroid(int(x), int(y))
+            brightness = sum_intensity[label] / pixel_count[label]
+            img_stars.append(ImageStar(centroid, brightness, perimeter, area))
+
+        img_stars = sorted(img_stars, key=lambda x: x.brightness, reverse=True)
+        return img_stars
+
+    @classmethod
+    def refine_centroids(cls, img_stars, gray, size=9):
+        """Replace the centroids of the given stars by sub-pixel ones.
+
+        For every star, a window of size x size pixels is taken from the
+        grayscale image around its centroid. The background, the median of
+        the window border, is subtracted and the float centroid is the
+        intensity-weighted mean of the remaining pixels. All the stars are
+        computed at once.
+
+        :param img_stars: List of ImageStar to refine.
+        :param gray: grayscale version of the original image
+        :param size: Odd size of the window around each star."""
+        if len(img_stars) == 0:
+            return
+
+        half = size // 2
+        height, width = gray.shape
+        centers_x = np.array([int(star.centroid.x) for star in img_stars])
+        centers_y = np.array([int(star.centroid.y) for star in img_stars])
+        offsets = np.arange(-half, half + 1)
+
+        # (stars, size, size) windows, clipped to the image borders
+        rows = np.clip(centers_y[:, None] + offsets, 0, height - 1)[:, :, None]
+        cols = np.clip(centers_x[:, None] + offsets, 0, width - 1)[:, None, :]
+        windows = gray[rows, cols].astype(np.float64)
+
+        border = np.concatenate([windows[:, 0, :], windows[:, -1, :],
+                                 windows[:, 1:-1, 0], windows[:, 1:-1, -1]], axis=1)
+        background = np.median(border, axis=1)
+        weights = np.clip(windows - background[:, None, None], 0, None)
+        total = weights.sum(axis=(1, 2))
+
+        # Keep the former centroid of flat windows
+        flat = total == 0
+        total[flat] = 1
+        refined_x = (weights * cols).sum(axis=(1, 2)) / total
+        refined_y = (weights * rows).sum(axis=(1, 2)) / total
+        for star, x, y, is_flat in zip(img_stars, refined_x, refined_y, flat):
+            if not is_flat:
+                star.centroid = Centroid(float(x), float(y))
+
     @classmethod
     def get_histogram_bytes(cls, img):
         """Calculate the histogram of a given image.
@@ -116,7 +343,7 @@ class ImageUtils:
         # Put name for identified stars
         for star in stars:
             if star.is_identified():
-                center = (star.centroid.x - 20, star.centroid.y - 10)
+                center = (int(star.centroid.x) - 20, int(star.centroid.y) - 10)
                 cv2.putText(img, str(star.real_star.name), center,
                             cv2.FONT_HERSHEY_SIMPLEX, 0.7, (255, 255, 255), 1)
 
@@ -126,7 +353,8 @@ class ImageUtils:
         draw lines in the image between them in order.
         :param img: Image to draw in.
         :param img_stars: List of stars to draw lines to.
-        :param pattern: Pattern of stars."""
+        :param pattern: Pattern of stars.
+        :param max: Number of brightest image stars to label."""
         # Build WCS
         pixels_x = np.array([])
         pixels_y = np.array([])
@@ -141,35 +369,50 @@ class ImageUtils:
         stars = SkyCoord(ra=stars_ra, dec=stars_dec, unit=u.deg)
         wcs = fit_wcs_from_points((pixels_x, pixels_y), stars)
 
-        img_stars_to_label = []
         for img_star in img_stars:
             for found_star in pattern:
                 if found_star.centroid == img_star.centroid and found_star.is_identified():
                     img_star.labeled = True
-            img_stars_to_label.append(img_star)
+        img_stars_to_label = [img_star for img_star in img_stars[:max]
+                              if not img_star.is_labeled()]
+        if len(img_stars_to_label) == 0:
+            return 0
 
-        # Set wcs coordinates to ImageStars
-        for img_star in img_stars:
-            pixel_x = np.array([[img_star.centroid.x]])
-            pixel_y = np.array([[img_star.centroid.y]])
-            coords_ra, coords_dec = wcs.wcs_pix2world(pixel_x, pixel_y, 0)
-            coords = SkyCoord(ra=coords_ra, dec=coords_dec, unit=u.deg)
-            img_star.set_wcs_coords(coords)
+        # Set wcs coordinates to the ImageStars, all of them at once
+        pixel_x = np.array([img_star.centroid.x for img_star in img_stars_to_label])
+        pixel_y = np.array([img_star.centroid.y for img_star in img_stars_to_label])
+        coords_ra, coords_dec = wcs.wcs_pix2world(pixel_x, pixel_y, 0)
+        coords = SkyCoord(ra=coords_ra, dec=coords_dec, unit=u.deg)
+        for i, img_star in enumerate(img_stars_to_label):
+            img_star.set_wcs_coords(coords[i])
+
+        # Guide stars in a cone around the image stars, in HIP order, the
+        # catalog of the server is loaded the first time it is used
+        catalog = server.catalog
+        img_vectors = catalog._compute_unit_vectors(coords_ra, coords_dec)
+        center_ra, center_dec = wcs.wcs_pix2world(np.array([pixel_x.mean()]),
+                                                  np.array([pixel_y.mean()]), 0)
+        center = catalog._compute_unit_vectors(center_ra, center_dec)[0]
+        radius = np.degrees(np.arccos(np.clip(img_vectors @ center, -1, 1)).max())
+        rows = catalog.cone_search(center_ra[0], center_dec[0], radius + 0.5)
+        cone_hips = np.sort(catalog._stars['hip'][rows])
+        guide_hips = cone_hips[np.isin(cone_hips, catalog._guide_stars)]
+        separations = np.degrees(np.arccos(np.clip(
+            img_vectors @ catalog.get_unit_vectors(guide_hips).T, -1, 1)))
 
+        # Every image star gets the first guide star closer than 0.5 degrees
+        close = separations < 0.5
+        found = close.any(axis=1)
+        first = np.argmax(close, axis=1)
         labeled = 0
-        for hip_number in catalog._guide_stars:
-            star = catalog.get_star_by_id(int(hip_number))
-            coords_a = SkyCoord(ra=star.ra, dec=star.dec, unit=u.deg)
-            max = 10
-            for img_star in img_stars_to_label[:max]:
-                if img_star.is_labeled():
-                    continue
-                coords_b = img_star.get_wcs_coords()
-                if coords_a.separation(coords_b) < 0.5 * u.deg:
-                    center = (img_star.centroid.x - 20, img_star.centroid.y + 25)
-                    cv2.putText(img, str(star.name), center,
-                                cv2.FONT_HERSHEY_SIMPLEX, 0.7, color, 1)
-                    labeled += 1
-                    img_star.set_labeled()
+        for img_star, is_found, index in zip(img_stars_to_label, found, first):
+            if not is_found:
+                continue
+            star = catalog.get_star_by_id(int(guide_hips[index]))
+            center = (int(img_star.centroid.x) - 20, int(img_star.centroid.y) + 25)
+            cv2.putText(img, str(star.name), center,
+                        cv2.FONT_HERSHEY_SIMPLEX, 0.7, color, 1)
+            labeled += 1
+            img_star.set_labeled()
 
         return labeled
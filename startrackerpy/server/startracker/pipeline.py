@@ -0,0 +1,203 @@
+import time
+import cv2
+import numpy as np
+from server.startracker.image import ImageUtils
+from server.startracker.tracking import PatternTracker
+from server.startracker.verification import SolutionVerifier
+
+
+class StarTrackerPipeline:
+    """Runs all the stages needed to find the stars pattern of a frame:
+    grayscale conversion, blur, histogram, threshold, stars extraction and
+    pattern matching.
+
+    The grayscale, blurred and thresholded images are written in buffers
+    allocated once for the frames resolution, so they are overwritten by
+    the next frame processed. A pipeline must not be shared between
+    threads.
+
+    In tracking mode, the stars identified in a frame are tracked in the
+    next one, and the full pattern search only runs when they are lost.
+    The patterns found by the full search can be verified with the rest of
+    the image stars before accepting them."""
+    STAGES = ['gray', 'blur', 'histogram', 'threshold', 'stars', 'pattern',
+              'verify']
+
+    def __init__(self, catalog, width=1280, height=960, thresh_max=170,
+                 err=0.010, tracking=False):
+        """
+        :param catalog: Catalog used to find the stars pattern.
+        :param width: Width of the frames to process.
+        :param height: Height of the frames to process.
+        :param thresh_max: Maximum value for the automatic threshold.
+        :param err: Maximum error allowed to find the pattern.
+        :param tracking: Track the stars between consecutive frames.
+        """
+        self._catalog = catalog
+        self._thresh_max = thresh_max
+        self._err = err
+        self._tracker = PatternTracker(catalog) if tracking else None
+        self._verifier = SolutionVerifier(catalog)
+        self._allocate(width, height)
+        self._hist = np.zeros((256, 1), dtype=np.float32)
+        self.threshold = None
+        self.stars = []
+        self.pattern = []
+        self.tracked = False
+        self.verification = None
+        self.timings = {}
+
+    def _allocate(self, width, height):
+        """Allocate the frame buffers for the given resolution."""
+        self._gray = np.empty((height, width), dtype=np.uint8)
+        self._blurred = np.empty((height, width), dtype=np.uint8)
+        self._thresh_image = np.empty((height, width), dtype=np.uint8)
+
+    @property
+    def gray(self):
+        """Grayscale image of the last frame."""
+        return self._gray
+
+    @property
+    def blurred(self):
+        """Blurred grayscale image of the last frame."""
+        return self._blurred
+
+    @property
+    def thresh_image(self):
+        """Thresholded image of the last frame."""
+        return self._thresh_image
+
+    @property
+    def hist(self):
+        """Histogram of the blurred image of the last frame."""
+        return self._hist
+
+    def reset_tracking(self):
+        """Forget the tracked stars, for example when a new sequence of
+        frames starts."""
+        if self._tracker is not None:
+            self._tracker.reset()
+
+    def get_pointing(self):
+        """Pointing of the camera in the last frame, fitted from the stars
+        identified in its pattern.
+
+        :return: (ra, dec, roll) in degrees, see PatternTracker.get_pointing,
+        None if the pattern was not found."""
+        if len(self.pattern) == 0:
+            return None
+        stars = [star for star in self.pattern[0] if star.is_identified()]
+        if len(stars) < 3:
+            return None
+
+        hips = [int(star.real_star.hip_number) for star in stars]
+        pixels = np.array([[star.centroid.x, star.centroid.y] for star in stars],
+                          dtype=np.float64)
+        attitude, _ = PatternTracker.fit_attitude(pixels,
+                                                  self._catalog.get_unit_vectors(hips))
+
+        return PatternTracker.get_pointing(attitude)
+
+    def _start(self, stage):
+        """Start timing a stage."""
+        self._stage = stage
+        self._stage_start = time.perf_counter()
+
+    def _stop(self):
+        """Record the time spent in the current stage."""
+        self.timings[self._stage] = time.perf_counter() - self._stage_start
+
+    def read(self, filename):
+        """Read an image file and process it.
+
+        :param filename: Path of the image.
+        :return: Stars pattern found, empty if there is no solution."""
+        start = time.perf_counter()
+        image = cv2.imread(filename)
+        read_time = time.perf_counter() - start
+        pattern = self.process(image)
+        self.timings['read'] = read_time
+
+        return pattern
+
+    def process(self, image, threshold=None, threshold_method="normal",
+                extraction="contours", subpixel=False, verify=False):
+        """Find the stars pattern of a BGR or grayscale frame.
+
+        The intermediate results are available afterwards in the `gray`,
+        `blurred`, `thresh_image`, `hist`, `threshold` and `stars`
+        attributes, and the time spent in each stage in `timings`. `tracked`
+        tells whether the pattern was found by tracking the previous frame
+        and `verification` has the result of SolutionVerifier.verify.
+
+        :param image: Frame to process.
+        :param threshold: Threshold value, automatic if it is not given.
+        :param threshold_method: Method for the automatic threshold, see
+        ImageUtils.get_threshold.
+        :param extraction: Stars extraction method, see
+        ImageUtils.get_image_stars.
+        :param subpixel: Refine the centroids with sub-pixel precision.
+        :param verify: Reject the patterns found by the full search which are
+        not verified by the rest of the image stars.
+        :return: Stars pattern found, empty if there is no solution."""
+        height, width = image.shape[:2]
+        if self._gray.shape != (height, width):
+            self._allocate(width, height)
+        self.timings = {}
+
+        self._start('gray')
+        if image.ndim == 2:
+            np.copyto(self._gray, image)
+        else:
+            cv2.cvtColor(image, cv2.COLOR_BGR2GRAY, dst=self._gray)
+        self._stop()
+
+        self._start('blur')
+        cv2.GaussianBlur(self._gray, (3, 3), 0, dst=self._blurred)
+        self._stop()
+
+        self._start('histogram')
+        cv2.calcHist([self._blurred], [0], None, [256], [0, 256], hist=self._hist)
+        self._stop()
+
+        self._start('threshold')
+        if threshold is None:
+            threshold = ImageUtils.get_threshold(self._blurred, self._thresh_max,
+                                                 method=threshold_method,
+                                                 hist=self._hist)
+        self.threshold = threshold
+        cv2.threshold(self._blurred, threshold, 255, cv2.THRESH_BINARY,
+                      dst=self._thresh_image)
+        self._stop()
+
+        self._start('stars')
+        self.stars = ImageUtils.get_image_stars(self._thresh_image, self._gray,
+                                                method=extraction,
+                                                subpixel=subpixel)
+        self._stop()
+
+        self._start('pattern')
+        self.pattern = []
+        self.tracked = False
+        if self._tracker is not None and self._tracker.is_tracking():
+            self.pattern = self._tracker.track(self.stars)
+            self.tracked = len(self.pattern) > 0
+        if not self.tracked and len(self.stars) >= 4:
+            self.pattern = self._catalog.find_stars_pattern(self.stars[0:4],
+                                                            err=self._err)
+        self._stop()
+
+        self.verification = None
+        if verify and not self.tracked and len(self.pattern) > 0:
+            self._start('verify')
+            self.verification = self._verifier.verify(self.stars, self.pattern,
+                                                      width, height)
+            if not self.verification['accepted']:
+                self.pattern = []
+            self._stop()
+
+        if self._tracker is not None and not self.tracked:
+            self._tracker.update(self.pattern, self.stars)
+
+        return self.pattern
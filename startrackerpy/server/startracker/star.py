@@ -7,7 +7,11 @@ from astropy import units as u
 class Star:
     """Represents a star and provides methods to convert coordinates,
     save a list of neighboors..."""
-    def __init__(self, hip_number, ra, dec, promora, promodec, parallax, vmag):
+    __slots__ = ['hip_number', 'name', 'ra', 'dec', 'promora', 'promodec',
+                 'parallax', 'vmag', '_unit_vector', '_neighbours']
+
+    def __init__(self, hip_number, ra, dec, promora, promodec, parallax, vmag,
+                 unit_vector=None):
         self.hip_number = hip_number
         self.name = ""
         self.ra = ra
@@ -16,7 +20,8 @@ class Star:
         self.promodec = promodec
         self.parallax = parallax
         self.vmag = vmag
-        self._neighbours = []
+        self._unit_vector = unit_vector
+        self._neighbours = None
 
     def __eq__(self, other):
         return self.hip_number == other.hip_number
@@ -31,25 +36,33 @@ class Star:
         """Add an Star as neighbour.
 
         :param star: Neighbour Star object"""
+        if self._neighbours is None:
+            self._neighbours = []
         self._neighbours.append(star)
 
     def get_neighbours(self):
         """Returns the list of neighbours.
 
         :return: List of Stars"""
+        if self._neighbours is None:
+            return []
         return self._neighbours
 
     def get_cartesian_coords(self):
         """Converts the given ra and dec to its cartesian coordinates.
-
-        :return: List of cartesian coords [x,y,z]"""
-        r = 1
-        dec = self.dec + 90
-        x = r * math.sin(np.deg2rad(dec)) * math.cos(np.deg2rad(self.ra))
-        y = r * math.sin(np.deg2rad(dec)) * math.sin(np.deg2rad(self.ra))
-        z = r * math.cos(np.deg2rad(dec))
-
-        return [x, y, z]
+        They are computed only once, stars from a Catalog get them from its
+        precomputed unit vectors.
+
+        :return: Cartesian coords [x,y,z]"""
+        if self._unit_vector is None:
+            r = 1
+            dec = self.dec + 90
+            x = r * math.sin(np.deg2rad(dec)) * math.cos(np.deg2rad(self.ra))
+            y = r * math.sin(np.deg2rad(dec)) * math.sin(np.deg2rad(self.ra))
+            z = r * math.cos(np.deg2rad(dec))
+            self._unit_vector = [x, y, z]
+
+        return self._unit_vector
 
     def get_distance(self, star):
         """Returns the angular distance to the given star.
@@ -0,0 +1,253 @@
+import numpy as np
+from server.startracker.image_star import Centroid, ImageStar
+
+
+class PatternTracker:
+    """Tracks the stars of a solved pattern along a sequence of frames.
+
+    The attitude of the camera, a matrix rotating camera unit vectors into
+    catalog unit vectors, is fitted from the identified stars of every
+    frame. The position of the tracked stars in the next frame is predicted
+    from the last attitude, rotated by the change between the last two
+    frames, and matched with the closest image star within a small search
+    radius. The matches are accepted when the attitude fitted from them
+    projects every star close to its image position, otherwise the tracking
+    is lost and the full search is needed."""
+    def __init__(self, catalog, search_radius=20, max_residual=3, min_stars=4,
+                 max_stars=10):
+        """
+        :param catalog: Catalog with the tracked stars.
+        :param search_radius: Maximum distance in pixels between the
+        predicted and the image star positions.
+        :param max_residual: Maximum distance in pixels between the image
+        stars and the catalog stars projected with the fitted attitude.
+        :param min_stars: Minimum number of stars matched to keep tracking.
+        :param max_stars: Maximum number of stars tracked, the pattern stars
+        are completed with the brightest guide stars found in the frame.
+        """
+        self._catalog = catalog
+        self._search_radius = search_radius
+        self._max_residual = max_residual
+        self._min_stars = min_stars
+        self._max_stars = max_stars
+        self._guide_hips = np.asarray(catalog._guide_stars, dtype=np.int64)
+        self._guide_vectors = catalog.get_unit_vectors(self._guide_hips)
+        self.reset()
+
+    def reset(self):
+        """Forget the tracked stars, the next frame needs a full search."""
+        self._hips = []
+        self._attitude = None
+        self._previous_attitude = None
+
+    def is_tracking(self):
+        """Whether there are stars to track in the next frame."""
+        return self._attitude is not None
+
+    @classmethod
+    def get_star_pixels(cls, img_stars):
+        """(N, 2) array with the centroids of the given stars."""
+        return np.array([[star.centroid.x, star.centroid.y] for star in img_stars],
+                        dtype=np.float64).reshape(-1, 2)
+
+    @classmethod
+    def get_camera_vectors(cls, pixels):
+        """Unit vectors in the camera frame of the given pixels, the same
+        ones ImageStar.get_unitary_vector returns.
+
+        :param pixels: (N, 2) array of x, y pixel coordinates.
+        :return: (N, 3) array"""
+        vectors = np.empty((len(pixels), 3))
+        vectors[:, 0] = (pixels[:, 0] - ImageStar.CENTER_X) / ImageStar.FOCAL_LENGTH
+        vectors[:, 1] = (pixels[:, 1] - ImageStar.CENTER_Y) / ImageStar.FOCAL_LENGTH
+        vectors[:, 2] = 1
+
+        return vectors / np.linalg.norm(vectors, axis=1)[:, None]
+
+    @classmethod
+    def get_pixels(cls, vectors):
+        """Pixels of the given unit vectors in the camera frame.
+
+        :param vectors: (N, 3) array of unit vectors.
+        :return: (N, 2) array of x, y pixel coordinates."""
+        pixels = np.empty((len(vectors), 2))
+        pixels[:, 0] = vectors[:, 0] / vectors[:, 2] * ImageStar.FOCAL_LENGTH + ImageStar.CENTER_X
+        pixels[:, 1] = vectors[:, 1] / vectors[:, 2] * ImageStar.FOCAL_LENGTH + ImageStar.CENTER_Y
+
+        return pixels
+
+    @classmethod
+    def fit_attitude(cls, pixels, catalog_vectors):
+        """Orthogonal matrix which best rotates the camera vectors of the
+        given pixels into the given catalog vectors. The catalog unit
+        vectors are mirrored, so it is not forced to be a proper rotation.
+
+        :param pixels: (N, 2) array of image star pixels.
+        :param catalog_vectors: (N, 3) array of catalog unit vectors, see
+        Catalog.get_unit_vectors.
+        :return: (attitude, residual), the 3x3 matrix and the maximum
+        distance in pixels between the image and projected stars."""
+        u, _, vt = np.linalg.svd(catalog_vectors.T @ cls.get_camera_vectors(pixels))
+        attitude = u @ vt
+        projected = cls.get_pixels(catalog_vectors @ attitude)
+        residual = np.max(np.linalg.norm(projected - pixels, axis=1))
+
+        return attitude, residual
+
+    @classmethod
+    def get_pointing(cls, attitude):
+        """Pointing of the camera for an attitude.
+
+        :param attitude: Attitude returned by fit_attitude.
+        :return: (ra, dec, roll) in degrees, the roll is the angle from
+        the north to the image y axis, towards the east."""
+        # Undo the mirrored z axis of the catalog unit vectors
+        mirror = np.array([1, 1, -1])
+        boresight = attitude @ np.array([0, 0, 1]) * mirror
+        y_axis = attitude @ np.array([0, 1, 0]) * mirror
+        ra = np.arctan2(boresight[1], boresight[0])
+        dec = np.arcsin(np.clip(boresight[2], -1, 1))
+        north = np.array([-np.sin(dec) * np.cos(ra), -np.sin(dec) * np.sin(ra),
+                          np.cos(dec)])
+        east = np.array([-np.sin(ra), np.cos(ra), 0])
+        roll = np.arctan2(y_axis @ east, y_axis @ north)
+
+        return (float(np.degrees(ra) % 360), float(np.degrees(dec)),
+                float(np.degrees(roll)))
+
+    def _fit_attitude(self, pixels, hips):
+        """fit_attitude with the catalog vectors of the given stars."""
+        return self.fit_attitude(pixels, self._catalog.get_unit_vectors(hips))
+
+    def _match(self, predicted, pixels):
+        """Match predicted positions with the closest image star within the
+        search radius, discarding the image stars matched twice.
+
+        :param predicted: (N, 2) array of predicted pixels.
+        :param pixels: (M, 2) array of image star pixels.
+        :return: (matched, closest), boolean mask over the predicted
+        positions and the image star row of each one."""
+        distances = np.linalg.norm(predicted[:, None, :] - pixels[None, :, :], axis=2)
+        closest = np.argmin(distances, axis=1)
+        matched = distances[np.arange(len(closest)), closest] < self._search_radius
+        counts = np.bincount(closest[matched], minlength=len(pixels))
+        matched &= counts[closest] == 1
+
+        return matched, closest
+
+    def _extend(self, attitude, stars, hips, img_stars):
+        """Add the guide stars found in the frame to the identified ones.
+
+        :param attitude: Attitude fitted from the identified stars.
+        :param stars: Identified ImageStar list.
+        :param hips: HIP numbers of the identified stars.
+        :param img_stars: ImageStar list of the frame, sorted by brightness.
+        :return: (attitude, stars, hips), the given ones if no new star
+        agrees with them."""
+        candidates = [star for star in img_stars[:self._max_stars]
+                      if not star.is_identified()]
+        if len(candidates) == 0 or len(stars) >= self._max_stars:
+            return attitude, stars, hips
+
+        guide_vectors = self._guide_vectors @ attitude
+        in_front = guide_vectors[:, 2] > 0
+        guide_hips = self._guide_hips[in_front]
+        guide_pixels = self.get_pixels(guide_vectors[in_front])
+        matched, closest = self._match(self.get_star_pixels(candidates), guide_pixels)
+
+        new_stars = list(stars)
+        new_hips = list(hips)
+        for star, row, is_matched in zip(candidates, closest, matched):
+            hip = int(guide_hips[row])
+            if is_matched and hip not in new_hips and len(new_hips) < self._max_stars:
+                new_stars.append(star)
+                new_hips.append(hip)
+        if len(new_stars) == len(stars):
+            return attitude, stars, hips
+
+        new_attitude, residual = self._fit_attitude(self.get_star_pixels(new_stars),
+                                                    new_hips)
+        if residual > self._max_residual:
+            return attitude, stars, hips
+
+        for star, hip in zip(new_stars[len(stars):], new_hips[len(hips):]):
+            star.set_real_star(self._catalog.get_star_by_id(hip))
+            star.set_identified(True)
+
+        return new_attitude, new_stars, new_hips
+
+    def update(self, pattern, img_stars=None):
+        """Start tracking the identified stars of a pattern.
+
+        :param pattern: Pattern returned by Catalog.find_stars_pattern or
+        by track, the tracking is reset if it is empty.
+        :param img_stars: ImageStar list of the frame, used to track more
+        stars than the pattern ones."""
+        if len(pattern) == 0:
+            self.reset()
+            return
+
+        stars = [star for star in pattern[0] if star.is_identified()]
+        if len(stars) < self._min_stars:
+            self.reset()
+            return
+
+        hips = [int(star.real_star.hip_number) for star in stars]
+        attitude, _ = self._fit_attitude(self.get_star_pixels(stars), hips)
+        if img_stars is not None:
+            attitude, stars, hips = self._extend(attitude, stars, hips, img_stars)
+        self._previous_attitude = self._attitude
+        self._attitude = attitude
+        self._hips = hips
+
+    def _predict_attitude(self):
+        """Attitude expected in the next frame, assuming the camera keeps
+        rotating as it did between the last two frames."""
+        if self._previous_attitude is None:
+            return self._attitude
+
+        return self._attitude @ self._previous_attitude.T @ self._attitude
+
+    def track(self, img_stars):
+        """Identify the tracked stars in a new frame.
+
+        :param img_stars: ImageStar list of the new frame.
+        :return: Pattern in the same format as Catalog.find_stars_pattern,
+        [image_stars, catalog_stars]: the identified ImageStars of the frame
+        and, in the same order, the catalog stars matched with them, as
+        ImageStars placed where the fitted attitude projects them. Empty if
+        the tracked stars were not found, in that case the tracking is
+        reset."""
+        if not self.is_tracking() or len(img_stars) < self._min_stars:
+            self.reset()
+            return []
+
+        catalog_vectors = self._catalog.get_unit_vectors(self._hips)
+        predicted = self.get_pixels(catalog_vectors @ self._predict_attitude())
+        pixels = self.get_star_pixels(img_stars)
+        matched, closest = self._match(predicted, pixels)
+        if np.count_nonzero(matched) < self._min_stars:
+            self.reset()
+            return []
+
+        rows = closest[matched]
+        hips = [hip for hip, is_matched in zip(self._hips, matched) if is_matched]
+        attitude, residual = self._fit_attitude(pixels[rows], hips)
+        if residual > self._max_residual:
+            self.reset()
+            return []
+
+        stars = [img_stars[row] for row in rows]
+        catalog_stars = []
+        projected = self.get_pixels(self._catalog.get_unit_vectors(hips) @ attitude)
+        for star, hip, (x, y) in zip(stars, hips, projected):
+            real_star = self._catalog.get_star_by_id(hip)
+            star.set_real_star(real_star)
+            star.set_identified(True)
+            catalog_star = ImageStar(Centroid(x, y), star.brightness)
+            catalog_star.set_real_star(real_star)
+            catalog_stars.append(catalog_star)
+        pattern = [stars, catalog_stars]
+        self.update(pattern, img_stars)
+
+        return pattern
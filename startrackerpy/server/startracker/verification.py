@@ -0,0 +1,100 @@
+import numpy as np
+from scipy.stats import binom
+from server.startracker.tracking import PatternTracker
+
+
+class SolutionVerifier:
+    """Verifies a stars pattern with the rest of the image stars.
+
+    The attitude is fitted from the identified stars of the pattern and the
+    brightest catalog stars in the field of view are projected into the
+    image. A solution is accepted when so many of the other image stars
+    land close to a projected star that it is very unlikely to happen by
+    chance: each image star has a probability of falling near one of the
+    projected stars equal to the fraction of the image they cover, and the
+    number of chance matches follows a binomial distribution."""
+    def __init__(self, catalog, tolerance=3, max_stars=20, max_predicted=40,
+                 min_probability=0.999):
+        """
+        :param catalog: Catalog used to project the stars.
+        :param tolerance: Maximum distance in pixels between an image star
+        and a projected star to count it as a match. The stars of the
+        correct solutions of the test images are within 2 pixels, and with
+        3 pixels two matches are enough to accept a solution.
+        :param max_stars: Number of brightest image stars checked, besides
+        the pattern ones.
+        :param max_predicted: Number of brightest catalog stars projected.
+        :param min_probability: Minimum probability of the solution not
+        being a chance match to accept it.
+        """
+        self._catalog = catalog
+        self._tolerance = tolerance
+        self._max_stars = max_stars
+        self._max_predicted = max_predicted
+        self._min_probability = min_probability
+
+    def _get_predicted(self, attitude, width, height):
+        """Pixels of the brightest catalog stars in the image.
+
+        :param attitude: Attitude fitted with PatternTracker.fit_attitude.
+        :param width: Width of the image.
+        :param height: Height of the image.
+        :return: (N, 2) array of pixels."""
+        ra, dec, _ = PatternTracker.get_pointing(attitude)
+        corners = np.array([[0, 0], [width, 0], [0, height], [width, height]],
+                           dtype=np.float64)
+        corner_vectors = PatternTracker.get_camera_vectors(corners)
+        radius = np.degrees(np.arccos(np.clip(corner_vectors[:, 2], -1, 1)).max())
+
+        rows = self._catalog.cone_search(ra, dec, radius)
+        vectors = self._catalog._unit_vectors[rows] @ attitude
+        vectors = vectors[vectors[:, 2] > 0]
+        pixels = PatternTracker.get_pixels(vectors)
+        in_image = (pixels[:, 0] >= 0) & (pixels[:, 0] < width) & \
+            (pixels[:, 1] >= 0) & (pixels[:, 1] < height)
+
+        return pixels[in_image][:self._max_predicted]
+
+    def verify(self, img_stars, pattern, width, height):
+        """Verify a pattern found in an image.
+
+        :param img_stars: ImageStar list of the image, sorted by brightness.
+        :param pattern: Pattern returned by Catalog.find_stars_pattern.
+        :param width: Width of the image.
+        :param height: Height of the image.
+        :return: dictionary with the number of image stars 'checked', the
+        'matches' found, the 'probability' of the solution not being a
+        chance match and whether it is 'accepted'."""
+        result = {'checked': 0, 'matches': 0, 'probability': 0.0,
+                  'accepted': False}
+        if len(pattern) == 0:
+            return result
+        identified = [star for star in pattern[0] if star.is_identified()]
+        if len(identified) < 3:
+            return result
+
+        hips = [int(star.real_star.hip_number) for star in identified]
+        attitude, _ = PatternTracker.fit_attitude(
+            PatternTracker.get_star_pixels(identified),
+            self._catalog.get_unit_vectors(hips))
+        predicted = self._get_predicted(attitude, width, height)
+
+        others = [star for star in img_stars
+                  if all(star is not found for found in identified)][:self._max_stars]
+        if len(others) == 0 or len(predicted) == 0:
+            return result
+
+        pixels = PatternTracker.get_star_pixels(others)
+        distances = np.linalg.norm(pixels[:, None, :] - predicted[None, :, :], axis=2)
+        matches = int(np.count_nonzero(distances.min(axis=1) < self._tolerance))
+
+        # Probability of an image star falling near a projected one by chance
+        chance = min(1.0, len(predicted) * np.pi * self._tolerance ** 2 / (width * height))
+        probability = 1 - binom.sf(matches - 1, len(others), chance)
+
+        result['checked'] = len(others)
+        result['matches'] = matches
+        result['probability'] = float(probability)
+        result['accepted'] = bool(probability >= self._min_probability)
+
+        return result
@@ -1,25 +1,66 @@
 import base64
 import time
 import zipfile
-import os
 import uuid
 import logging
+import threading
 from io import BytesIO
 from pathlib import Path
 import cv2
+import numpy as np
 from flask import render_template, jsonify, request, send_file
 from server import app, catalog
 from server.cam import Cam
+from server.capture import FrameRing
+from server.burst_writer import ENCODINGS, read_frame, delete_frames
 from server.metrics import Metrics
 from server.sensors import DS1621, LSM303, CPU_SENSOR
 from server.db import Db
 from server.startracker.image import ImageUtils
+from server.startracker.pipeline import StarTrackerPipeline
 
 
 CAM = Cam()
 # Current file Path
 FILE_PATH = Path(__file__).parent.absolute()
 DB = Db(f"{FILE_PATH}/data/startrackerpy.db")
+# Formats a burst can be downloaded in
+DOWNLOAD_FORMATS = ENCODINGS + ('jpeg',)
+# Frame processing pipelines, one per thread as they own their buffers
+PIPELINES = threading.local()
+
+
+def get_pipeline():
+    """Returns the StarTrackerPipeline of the current thread."""
+    if not hasattr(PIPELINES, 'pipeline'):
+        PIPELINES.pipeline = StarTrackerPipeline(catalog)
+
+    return PIPELINES.pipeline
+
+
+def capture_frame(cam_params):
+    """Returns a frame taken with the given camera parameters once they
+    settled, from the capture daemon when it is running, otherwise from
+    the camera device.
+
+    :param cam_params: Dictionary with the camera parameters.
+    """
+    ring = FrameRing.attach_running()
+    if ring is not None:
+        try:
+            _, _, frame = ring.wait_frame(cam_params)
+        finally:
+            ring.close()
+        return frame
+
+    CAM.lock_acquire()
+    try:
+        CAM.set_camera_params(cam_params)
+        _, frame = CAM.read_settled()
+    finally:
+        CAM.lock_release()
+
+    return frame
 
 
 @app.route("/")
@@ -43,12 +84,8 @@ def current_frame():
         'exposure': int(request.args.get('exposure')),
     }
 
-    CAM.lock_acquire()
-    CAM.set_camera_params(cam_params)
-    time.sleep(1)
-    _, frame = CAM.read()
+    frame = capture_frame(cam_params)
     frame = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-    CAM.lock_release()
     Path(images_path).mkdir(parents=True, exist_ok=True)
     uid = uuid.uuid1()
     _, im_arr = cv2.imencode('.jpg', frame)
@@ -74,13 +111,8 @@ def current_frame_tiff():
         'gain': int(request.args.get('gain')),
         'exposure': int(request.args.get('exposure')),
     }
-    CAM.lock_acquire()
-    CAM.set_camera_params(cam_params)
-    # Give some time to set the camera parameters
-    time.sleep(1.5)
-    _, frame = CAM.read()
+    frame = capture_frame(cam_params)
     cv2.imwrite('test.tiff', frame)
-    CAM.lock_release()
 
     return "Done"
 
@@ -89,7 +121,20 @@ def current_frame_tiff():
 def get_camera_params():
     """ Returns a JSON with the current parameters of the camera.
     """
-    params = CAM.get_camera_params()
+    # The capture daemon owns the device, use the ones of its last frame
+    ring = FrameRing.attach_running()
+    if ring is not None:
+        try:
+            params = ring.get_params(ring.latest_seq())
+        finally:
+            ring.close()
+        return jsonify(params or {})
+
+    CAM.lock_acquire()
+    try:
+        params = CAM.get_camera_params()
+    finally:
+        CAM.lock_release()
 
     return jsonify(params)
 
@@ -114,6 +159,14 @@ def queue_burst():
     gamma = int(request.args.get('gamma'))
     gain = int(request.args.get('gain'))
     exposure = int(request.args.get('exposure'))
+    encoding = request.args.get('encoding', 'tiff')
+
+    if encoding not in ENCODINGS:
+        return jsonify({
+            'result': 'error',
+            'id': -1,
+            'msg': f"Unknown encoding {encoding}"
+        })
 
     if int(duration) / int(interval) > 600:
         return jsonify({
@@ -124,7 +177,7 @@ def queue_burst():
 
     # Add a row to queue the burst
     row_id = DB.insert_burst(duration, interval, brightness, gamma,
-                             gain, exposure)
+                             gain, exposure, encoding)
 
     return jsonify({
         'result': 'ok',
@@ -141,24 +194,51 @@ def get_bursts():
     return render_template('bursts.html', bursts=bursts)
 
 
+@app.route("/get-burst-frames")
+def get_burst_frames():
+    """Returns a JSON with the capture time and the jitter, the seconds
+    between the scheduled and the capture time, of every frame of a burst,
+    and its pointing once the burst is solved.
+    """
+    burst_id = int(request.args.get('burstId'))
+    frames = [dict(frame) for frame in DB.get_burst_frames(burst_id)]
+
+    return jsonify(frames)
+
+
 @app.route("/download-burst")
 def download_burst():
-    """Returns an html table with the burst retrieved from the DB.
+    """Returns a zip file with the frames of a burst in the given format,
+    one of DOWNLOAD_FORMATS.
     """
     images_path = "server/data/bursts"
     burst_id = int(request.args.get('burstId'))
     burst_format = request.args.get('format')
+    # The format is used in the file names
+    if burst_format not in DOWNLOAD_FORMATS:
+        return jsonify({
+            'result': 'error',
+            'msg': f"Unknown format {burst_format}"
+        }), 400
     burst = DB.get_burst(burst_id)
     files = int(burst['duration'] / burst['interval'])
+    written = {frame['frame'] for frame in DB.get_burst_frames(burst_id)}
 
     memory_file = BytesIO()
     with zipfile.ZipFile(memory_file, 'w') as zf:
         for i in range(1, files+1):
-            image_name = "{}/{}_{}.tiff".format(images_path, burst_id, i)
-            image_data = cv2.imread(image_name)
-            if burst_format == "jpeg":
-                _, image_data = cv2.imencode(".jpeg", image_data)
-            image_bytes = image_data.tobytes()
+            image_data = read_frame(images_path, burst_id, i, burst['encoding'],
+                                    written)
+            # Frames dropped during the burst
+            if image_data is None:
+                continue
+            if burst_format == 'npy':
+                image_file = BytesIO()
+                np.save(image_file, image_data)
+                image_bytes = image_file.getvalue()
+            else:
+                _, image_data = cv2.imencode(f".{burst_format}", image_data)
+                image_bytes = image_data.tobytes()
             data = zipfile.ZipInfo("{}_{}.{}".format(burst_id, i, burst_format))
             data.date_time = time.localtime(time.time())[:6]
             data.compress_type = zipfile.ZIP_DEFLATED
@@ -178,12 +258,10 @@ def delete_burst():
     burst_id = int(request.args.get('burstId'))
     burst = DB.get_burst(burst_id)
     files = int(burst['duration'] / burst['interval'])
-    for i in range(1, files+1):
-        try:
-            image_name = "{}/{}_{}.tiff".format(images_path, burst_id, i)
-            os.remove(image_name)
-        except Exception as e:
-            print(e)
+    try:
+        delete_frames(images_path, burst_id, files, burst['encoding'])
+    except Exception as e:
+        print(e)
     DB.delete_burst(burst_id)
 
     return "Done"
@@ -215,41 +293,46 @@ def process_image():
     """Process the given image to find stars and returns
     the image with the associated data"""
     auto_threshold = request.args.get('auto_threshold')
+    threshold_method = request.args.get('threshold_method', 'normal')
     label_guide_stars = request.args.get('label_guide_stars')
+    extraction = request.args.get('extraction', 'contours')
+    subpixel = request.args.get('subpixel') == "true"
+    verify = request.args.get('verify') == "true"
     images_path = f"{FILE_PATH}/data/images"
     response = {}
     response['results'] = {}
     uid = request.args.get('uuid')
     image = cv2.imread(f"{images_path}/{uid}")
-    gray_img = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-    blurred = cv2.GaussianBlur(gray_img, (3, 3), 0)
 
     # Check if auto threshold was selected
     logging.warning(auto_threshold)
-    if auto_threshold == "true":
-        threshold = ImageUtils.get_threshold(blurred, 170)
-        msg = {'type': 'info', 'msg': f'Automatic threshold selected: {threshold}'}
+    threshold = None
+    if auto_threshold != "true":
+        threshold = int(request.args.get('threshold'))
 
+    pipeline = get_pipeline()
+    pattern = pipeline.process(image, threshold=threshold,
+                               threshold_method=threshold_method,
+                               extraction=extraction, subpixel=subpixel,
+                               verify=verify)
+    stars = pipeline.stars
+
+    if auto_threshold == "true":
+        msg = {'type': 'info',
+               'msg': f'Automatic threshold ({threshold_method}) selected: {pipeline.threshold}'}
     else:
-        threshold = int(request.args.get('threshold'))
         msg = {'type': 'info', 'msg': f'Threshold selected by user input: {threshold}'}
 
     response['results']['threshold'] = msg
 
-    # Get the threshold image
-    thresh_image = cv2.threshold(blurred, threshold, 255, cv2.THRESH_BINARY)[1]
     # Convert to bytes and encode in base64 to send it in the response
-    _, im_arr = cv2.imencode('.jpg', thresh_image)
+    _, im_arr = cv2.imencode('.jpg', pipeline.thresh_image)
     im_bytes = im_arr.tobytes()
     img_b64 = base64.b64encode(im_bytes).decode("ascii")
     response['b64_thresh_img'] = img_b64
 
-    # Get possible image stars
-    stars = ImageUtils.get_image_stars(thresh_image, gray_img)
     # Find pattern if there are at least 4 possible images
-    pattern = []
     if len(stars) >= 4:
-        pattern = catalog.find_stars_pattern(stars[0:4], err=0.010)
         _, im_arr = cv2.imencode('.jpg', image)
         im_bytes = im_arr.tobytes()
         img_b64 = base64.b64encode(im_bytes).decode("ascii")
@@ -259,9 +342,21 @@ def process_image():
         msg = {'type': 'info', 'msg': f'Possible stars found in the image: {len(stars)}'}
     response['results']['stars'] = msg
 
+    # Verification of the pattern with the rest of the stars
+    if pipeline.verification is not None:
+        verification = pipeline.verification
+        msg_type = 'info' if verification['accepted'] else 'Error'
+        msg = {'type': msg_type,
+               'msg': f"Pattern verified by {verification['matches']} of "
+                      f"{verification['checked']} stars, probability: "
+                      f"{verification['probability']:.4f}"}
+        response['results']['verification'] = msg
+
     # Histogram
-    hist = cv2.calcHist([blurred], [0], None, [256], [0, 256])
-    response['hist'] = hist.tolist()
+    response['hist'] = pipeline.hist.tolist()
+    # Time spent in each stage, in milliseconds
+    response['timings'] = {stage: elapsed * 1000
+                           for stage, elapsed in pipeline.timings.items()}
 
     # If a pattern was found
     if len(pattern) > 0:
@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+"""Solve a batch of images in parallel, writing a JSON line per image with
+the stars found, the pattern, the camera pointing, the threshold and the
+time spent in each stage:
+
+    python solve_batch.py -i ./server/startracker/test_images/ballon -o ballon.jsonl
+
+Every worker process loads the catalog once. With a compiled bundle, see
+compile_catalog.py, the arrays are memory-mapped and shared between them.
+"""
+import argparse
+import json
+import os
+import time
+from multiprocessing import Pool
+from pathlib import Path
+import cv2
+from server.startracker.catalog import Catalog
+from server.startracker.pipeline import StarTrackerPipeline
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp', '.tif', '.tiff')
+
+# Pipeline of the worker process
+pipeline = None
+options = {}
+
+
+def init_worker(catalog_args, pipeline_options):
+    """Load the catalog and create the pipeline of a worker process.
+
+    :param catalog_args: Keyword arguments for the Catalog.
+    :param pipeline_options: Keyword arguments for StarTrackerPipeline.process."""
+    global pipeline, options
+    pipeline = StarTrackerPipeline(Catalog(**catalog_args))
+    options = pipeline_options
+
+
+def solve(filename):
+    """Solve an image in the worker process.
+
+    :return: dictionary with the results of the image."""
+    record = {'image': filename}
+    start = time.perf_counter()
+    image = cv2.imread(filename)
+    if image is None:
+        record['error'] = "The image could not be read"
+        return record
+    read_time = time.perf_counter() - start
+
+    pattern = pipeline.process(image, **options)
+    identified = [star for star in pattern[0] if star.is_identified()] if pattern else []
+    pointing = pipeline.get_pointing()
+    timings = dict(pipeline.timings, read=read_time)
+
+    record['threshold'] = int(pipeline.threshold)
+    record['stars'] = len(pipeline.stars)
+    record['solved'] = len(pattern) > 0
+    record['pattern'] = [int(star.real_star.hip_number) for star in pattern[1]] \
+        if pattern else []
+    record['identified'] = [{'hip': int(star.real_star.hip_number),
+                             'x': float(star.centroid.x),
+                             'y': float(star.centroid.y)}
+                            for star in identified]
+    record['verification'] = pipeline.verification
+    record['pointing'] = dict(zip(['ra', 'dec', 'roll'], pointing)) if pointing else None
+    record['timings'] = {stage: elapsed * 1000 for stage, elapsed in timings.items()}
+
+    return record
+
+
+def list_images(paths):
+    """Image files of the given files and directories, sorted by name."""
+    images = []
+    for path in paths:
+        if os.path.isdir(path):
+            images += [str(filename) for filename in sorted(Path(path).rglob('*'))
+                       if filename.suffix.lower() in IMAGE_EXTENSIONS]
+        else:
+            images.append(path)
+
+    return images
+
+
+def main(args):
+    if args.bundle is not None:
+        catalog_args = {'bundle': args.bundle}
+    else:
+        catalog_args = {'hip_csv': args.hip,
+                        'guide_stars_csv': args.guide_stars,
+                        'guide_stars_labels_csv': args.labels}
+    pipeline_options = {'threshold_method': args.threshold_method,
+                        'extraction': args.extraction,
+                        'subpixel': args.subpixel,
+                        'verify': args.verify}
+    images = list_images(args.images)
+    print(f"Solving {len(images)} images with {args.processes or os.cpu_count()} processes")
+
+    start = time.perf_counter()
+    solved = 0
+    with Pool(args.processes, initializer=init_worker,
+              initargs=(catalog_args, pipeline_options)) as pool, \
+            open(args.output, 'w') as output:
+        for record in pool.imap_unordered(solve, images, chunksize=args.chunk_size):
+            output.write(json.dumps(record) + "\n")
+            solved += record.get('solved', False)
+
+    elapsed = time.perf_counter() - start
+    print(f"Solved {solved}/{len(images)} images in {elapsed:.1f}s, "
+          f"results written to {args.output}")
+
+
+if __name__ == "__main__":
+    catalogs_path = "./server/startracker/catalogs/out"
+    default_bundle = f"{catalogs_path}/catalog_2000_5"
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-i', '--images', required=True, dest='images', nargs='+',
+                        help='Images or directories of images to solve')
+    parser.add_argument('-o', '--output', required=True, dest='output',
+                        help='Output JSONL path')
+    parser.add_argument('-p', '--processes', dest='processes', type=int,
+                        default=None, help='Number of processes, all the CPUs '
+                        'by default')
+    parser.add_argument('--chunk-size', dest='chunk_size', type=int, default=4,
+                        help='Images sent to a process at once')
+    parser.add_argument('-b', '--bundle', dest='bundle',
+                        default=default_bundle if os.path.isdir(default_bundle) else None,
+                        help='Compiled catalog bundle, used instead of the CSVs')
+    parser.add_argument('-c', '--hip', dest='hip',
+                        default=f"{catalogs_path}/hip_2000.csv",
+                        help='Propagated Hipparcos catalog CSV path')
+    parser.add_argument('-g', '--guide-stars', dest='guide_stars',
+                        default=f"{catalogs_path}/guide_stars_2000_5.csv",
+                        help='Guide stars pairs CSV path')
+    parser.add_argument('-l', '--labels', dest='labels',
+                        default=f"{catalogs_path}/guide_stars_2000_5_labels.csv",
+                        help='Guide stars labels CSV path')
+    parser.add_argument('-t', '--threshold-method', dest='threshold_method',
+                        default='normal',
+                        choices=['normal', 'sigma_clip', 'otsu', 'triangle'],
+                        help='Automatic threshold method')
+    parser.add_argument('-e', '--extraction', dest='extraction',
+                        default='contours', choices=['contours', 'components'],
+                        help='Stars extraction method')
+    parser.add_argument('--subpixel', dest='subpixel', action='store_true',
+                        help='Refine the centroids with sub-pixel precision')
+    parser.add_argument('--verify', dest='verify', action='store_true',
+                        help='Reject the solutions not verified by the rest '
+                        'of the stars')
+
+    main(parser.parse_args())
@@ -1,40 +1,65 @@
 #!/usr/bin/env python3
-import cv2
-import time
+"""Solve the images of a directory, printing how many were solved and the
+mean time spent in each stage of the pipeline:
+
+    python test_algorithm.py -i ./server/startracker/test_images/ballon
+"""
+import argparse
 import os
 from server.startracker.catalog import Catalog
-from server.startracker.image import ImageUtils
-
-assets_dir = "/home/igarcia/Nextcloud/University/TFG/reports/assets"
-catalogs_path = "./server/startracker/catalogs/out"
-catalog = Catalog(f"{catalogs_path}/hip_2000.csv",
-                    f"{catalogs_path}/guide_stars_2000_5.csv",
-                    f"{catalogs_path}/guide_stars_2000_5_labels.csv")
-
-images_path = "./server/startracker/test_images/ballon"
-
-total = 0
-found = 0
-not_enough = 0
-for filename in os.listdir(images_path):
-    print(f"processing image: {filename}")
-    image = cv2.imread(f"{images_path}/{filename}")
-    gray_img = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-    # Noise reduction
-    blurred = cv2.GaussianBlur(gray_img, (3, 3), 0)
-    threshold = ImageUtils.get_threshold(blurred, 170)
-    thresh_image = cv2.threshold(blurred, threshold, 255, cv2.THRESH_BINARY)[1]
-    stars = ImageUtils.get_image_stars(thresh_image, gray_img)
-    if len(stars) >= 4:
-        pattern = catalog.find_stars_pattern(stars[0:4], err=0.010)
-        if len(pattern) > 0:
-            found += 1
+from server.startracker.pipeline import StarTrackerPipeline
+
+
+def main(args):
+    if args.bundle is not None:
+        catalog = Catalog(bundle=args.bundle)
     else:
-        print(f"Not enough stars for: {filename}")
-        not_enough += 1
+        catalog = Catalog(args.hip, args.guide_stars, args.labels)
+    pipeline = StarTrackerPipeline(catalog)
+
+    total = 0
+    found = 0
+    not_enough = 0
+    timings = {}
+    for filename in os.listdir(args.images):
+        print(f"processing image: {filename}")
+        pattern = pipeline.read(f"{args.images}/{filename}")
+        if len(pipeline.stars) >= 4:
+            if len(pattern) > 0:
+                found += 1
+        else:
+            print(f"Not enough stars for: {filename}")
+            not_enough += 1
+
+        for stage, elapsed in pipeline.timings.items():
+            timings[stage] = timings.get(stage, 0) + elapsed
+        total += 1
+
+    print(f"Analyzed a total of {total} stars")
+    print(f"Found solution for {found}")
+    print(f"Not enough stars {not_enough}")
+    for stage, elapsed in timings.items():
+        print(f"Mean {stage} time: {elapsed * 1000 / max(total, 1):.2f} ms")
+
 
-    total += 1
+if __name__ == "__main__":
+    catalogs_path = "./server/startracker/catalogs/out"
+    default_bundle = f"{catalogs_path}/catalog_2000_5"
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-i', '--images', dest='images',
+                        default='./server/startracker/test_images/ballon',
+                        help='Directory with the images to solve')
+    parser.add_argument('-b', '--bundle', dest='bundle',
+                        default=default_bundle if os.path.isdir(default_bundle) else None,
+                        help='Compiled catalog bundle, used instead of the CSVs')
+    parser.add_argument('-c', '--hip', dest='hip',
+                        default=f"{catalogs_path}/hip_2000.csv",
+                        help='Propagated Hipparcos catalog CSV path')
+    parser.add_argument('-g', '--guide-stars', dest='guide_stars',
+                        default=f"{catalogs_path}/guide_stars_2000_5.csv",
+                        help='Guide stars pairs CSV path')
+    parser.add_argument('-l', '--labels', dest='labels',
+                        default=f"{catalogs_path}/guide_stars_2000_5_labels.csv",
+                        help='Guide stars labels CSV path')
 
-print(f"Analyzed a total of {total} stars")
-print(f"Found solution for {found}")
-print(f"Not enough stars {not_enough}")
+    main(parser.parse_args())
@@ -0,0 +1,131 @@
+import csv
+import tempfile
+import unittest
+import numpy as np
+from server.startracker.catalog import Catalog
+
+# HIP numbers of the synthetic catalog, around the 16 bits boundary and up
+# to the last Hipparcos star
+HIP_NUMBERS = [1, 2, 3, 7, 100, 4096, 65535, 65536, 65537, 100000, 120416]
+# Guide pairs (hip_a, hip_b, distance), some of them with the same distance
+GUIDE_PAIRS = [
+    (1, 2, 0.5),
+    (3, 1, 1.25),
+    (2, 3, 1.25),
+    (7, 100, 2.0),
+    (65535, 65536, 2.0),
+    (65537, 65535, 7.75),
+    (100, 65537, 10.5),
+    (120416, 1, 17.98),
+    (4096, 120416, 35.9),
+]
+
+
+def search_pair_distance(catalog, hip_a, hip_b):
+    """Former lookup, a scan of the pairs returned by the distance search
+    over the whole catalog."""
+    for pair_a, pair_b, distance in catalog.get_pairs_by_distance(-1, 181):
+        if (pair_a, pair_b) in ((hip_a, hip_b), (hip_b, hip_a)):
+            return distance
+
+    return None
+
+
+class CatalogTestCase(unittest.TestCase):
+    """Builds the synthetic catalog, shared by the tests of the class."""
+    @classmethod
+    def setUpClass(cls):
+        cls._tmp = tempfile.TemporaryDirectory()
+        hip_csv = f"{cls._tmp.name}/hip_2000.csv"
+        guide_csv = f"{cls._tmp.name}/guide_stars_2000_5.csv"
+        with open(hip_csv, 'w') as csv_file:
+            writer = csv.writer(csv_file)
+            writer.writerow(['HIP_number', 'ra_degrees', 'dec_degrees',
+                             'promora', 'promodec', 'parallax', 'vmag'])
+            for i, hip in enumerate(HIP_NUMBERS):
+                writer.writerow([hip, i * 30, i * 15 - 75, 0, 0, 0, 4])
+        with open(guide_csv, 'w') as csv_file:
+            writer = csv.writer(csv_file)
+            writer.writerow(['HIP_number_a', 'HIP_number_b', 'distance'])
+            for hip_a, hip_b, distance in GUIDE_PAIRS:
+                writer.writerow([hip_a, hip_b, repr(distance)])
+        cls.catalog = Catalog(hip_csv, guide_csv)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls._tmp.cleanup()
+
+
+class TestGetPairDistance(CatalogTestCase):
+    def test_exact_pairs(self):
+        for hip_a, hip_b, distance in GUIDE_PAIRS:
+            for pair in ((hip_a, hip_b), (hip_b, hip_a)):
+                self.assertEqual(self.catalog.get_pair_distance(*pair), distance)
+                self.assertEqual(self.catalog.get_pair_distance(*pair),
+                                 search_pair_distance(self.catalog, *pair))
+
+    def test_numpy_hip_numbers(self):
+        # The pattern search passes the HIP numbers as floats and numpy types
+        self.assertEqual(self.catalog.get_pair_distance(np.float64(65537),
+                                                        np.int32(100)), 10.5)
+
+    def test_boundary_pairs(self):
+        # Shortest and longest pairs, and pairs with the same distance
+        for hip_a, hip_b, distance in GUIDE_PAIRS:
+            below = np.nextafter(distance, -np.inf)
+            above = np.nextafter(distance, np.inf)
+            pairs = self.catalog.get_pairs_by_distance(below, above)
+            self.assertIn([hip_a, hip_b, distance], pairs)
+            for pair_a, pair_b, pair_distance in pairs:
+                self.assertEqual(self.catalog.get_pair_distance(pair_a, pair_b),
+                                 pair_distance)
+        self.assertEqual(self.catalog.get_pair_distance(1, 2), 0.5)
+        self.assertEqual(self.catalog.get_pair_distance(120416, 4096), 35.9)
+        self.assertEqual(len(self.catalog.get_pairs_by_distance(1.2, 1.3)), 2)
+
+    def test_missing_pairs(self):
+        missing = [
+            # Catalog stars which are not a guide pair
+            (1, 7), (2, 65535), (65536, 65537), (4096, 100000),
+            # A star with itself
+            (1, 1), (120416, 120416),
+            # Stars not in the catalog, below, between and above its keys
+            (0, 1), (2, 4), (65534, 65536), (120416, 120417), (1, 2**31 - 1),
+        ]
+        for hip_a, hip_b in missing:
+            self.assertIsNone(self.catalog.get_pair_distance(hip_a, hip_b))
+            self.assertIsNone(search_pair_distance(self.catalog, hip_a, hip_b))
+
+
+class TestUnitVectors(CatalogTestCase):
+    def test_unit_vectors(self):
+        vectors = self.catalog.get_unit_vectors(HIP_NUMBERS)
+        self.assertEqual(vectors.shape, (len(HIP_NUMBERS), 3))
+        np.testing.assert_allclose(np.linalg.norm(vectors, axis=1), 1)
+        # Two stars in the catalog, HIP 65535 in the row of HIP 7 and the
+        # other way around
+        np.testing.assert_array_equal(self.catalog.get_unit_vectors([65535, 7]),
+                                      vectors[[6, 3]])
+
+    def test_missing_stars(self):
+        for hips in ([5], [1, 4], [0], [-1], [120417], [2**31 - 1]):
+            with self.assertRaises(KeyError):
+                self.catalog.get_unit_vectors(hips)
+            with self.assertRaises(KeyError):
+                self.catalog.get_distances(hips, [1] * len(hips))
+
+    def test_distances(self):
+        # HIP 1 at (0, -75) and HIP 2 at (30, -60)
+        expected = np.degrees(np.arccos(
+            np.sin(np.radians(-75)) * np.sin(np.radians(-60))
+            + np.cos(np.radians(-75)) * np.cos(np.radians(-60)) * np.cos(np.radians(30))))
+        distances = self.catalog.get_distances([1, 2], [2, 1])
+        np.testing.assert_allclose(distances, [expected, expected])
+        # The distance of a star with itself is 0, never NaN
+        distances = self.catalog.get_distances(HIP_NUMBERS, HIP_NUMBERS)
+        self.assertFalse(np.any(np.isnan(distances)))
+        np.testing.assert_allclose(distances, 0, atol=1e-5)
+
+
+if __name__ == '__main__':
+    unittest.main()